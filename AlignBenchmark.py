@@ -0,0 +1,73 @@
+import sys
+import time
+import cv2
+import numpy as np
+from ImageAligner import ImageAligner
+from ImageSource import ImageSource
+
+DATASETS = ["./test1", "./sailboat", "./sources"]
+
+# (name, coarse_level, refine_iterations)
+MODES = [
+    ("coarse-1", 1, 0),
+    ("coarse-2", 2, 0),
+    ("coarse-2+ecc", 2, 10),
+]
+
+
+def reprojection_error(homography, reference_homography, shape):
+    """
+    Mean distance, in pixels, between a grid of points of an image of 'shape' mapped
+    by both homographies.
+    """
+    xs, ys = np.meshgrid(np.linspace(0, shape[1] - 1, 16), np.linspace(0, shape[0] - 1, 16))
+    points = np.dstack((xs.ravel(), ys.ravel())).astype(np.float32).reshape(-1, 1, 2)
+
+    mapped = cv2.perspectiveTransform(points, homography)
+    reference = cv2.perspectiveTransform(points, reference_homography)
+    return float(np.mean(np.sqrt(np.sum((mapped - reference) ** 2, axis=2))))
+
+
+def time_homography(aligner, primary_image, secondary_image):
+    """
+    Return (homography, seconds). Features are detected on every call.
+    """
+    aligner.feature_cache.clear()
+    start = time.time()
+    homography = aligner.estimate_homography(primary_image, secondary_image)
+    return homography, time.time() - start
+
+
+def run_benchmark(dataset):
+    image_source = ImageSource()
+    if not image_source.load_images(dataset):
+        print "[ERROR] AlignBenchmark - Could not load images from " + dataset
+        return
+
+    primary_image = image_source.get_primary_image()
+    reference_aligner = ImageAligner()
+    aligners = [(name, ImageAligner(coarse_level=level, refine_iterations=iterations))
+                for name, level, iterations in MODES]
+
+    print "%s (%dx%d)" % (dataset, primary_image.shape[1], primary_image.shape[0])
+    print "  %-6s %10s" % ("image", "full"),
+    for name, aligner in aligners:
+        print "%26s" % name,
+    print
+
+    for index in range(image_source.get_number_of_secondary_images()):
+        secondary_image = image_source.get_secondary_image(index)
+        reference_homography, reference_time = time_homography(reference_aligner, primary_image, secondary_image)
+
+        print "  %-6d %8.1fms" % (index, reference_time * 1000),
+        for name, aligner in aligners:
+            homography, elapsed = time_homography(aligner, primary_image, secondary_image)
+            error = reprojection_error(homography, reference_homography, primary_image.shape)
+            print "%8.1fms %5.1fx %6.2fpx" % (elapsed * 1000, reference_time / elapsed, error),
+        print
+
+
+if __name__ == "__main__":
+    datasets = sys.argv[1:] if len(sys.argv) > 1 else DATASETS
+    for dataset in datasets:
+        run_benchmark(dataset)
@@ -1,4 +1,5 @@
 from ImageAligner import ImageAligner
+from ImageOverlay import ImageOverlay
 from ImageSource import ImageSource
 import cv2
 
@@ -7,14 +8,9 @@ image_source = ImageSource();
 loaded = image_source.load_images("./sources")
 
 if(loaded):
-    output_img = ImageAligner().align_image(image_source.primary_image, image_source.secondary_images[0]);
+    output_img = ImageAligner().align_image(image_source.primary_image, image_source.get_secondary_image(0));
     cv2.imwrite('./sources/original_warp.png', output_img)
 
-    output_image = image_source.primary_image
-
-    for row in range(len(output_img)):
-        for col in range(len(output_img[0])):
-            if output_img[row][col][0] > 0:
-                output_image[row][col] = output_img[row][col]
+    output_image = ImageOverlay().build_merge(image_source.primary_image, output_img)
 
     cv2.imwrite('./sources/simple_merge.png', output_image)
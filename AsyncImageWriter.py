@@ -0,0 +1,80 @@
+import collections
+import threading
+import cv2
+import os
+import Profiler
+
+
+class AsyncImageWriter:
+    """
+    Encodes and writes images on a background thread, so callers do not wait for cv2.imwrite().
+
+    Writes are done in the order they were queued. A write to a filename that is still queued
+    replaces the queued image, so only the latest version of a file is encoded.
+    Queued images are not copied: do not modify an image after passing it to write().
+    """
+
+    def __init__(self):
+        self.pending_filenames = collections.deque()
+        self.pending_images = {}
+        self.writing = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+
+    def write(self, filename, image):
+        """
+        Queue image to be written to filename. Missing folders are created.
+        """
+        with self.condition:
+            if filename not in self.pending_images:
+                self.pending_filenames.append(filename)
+            self.pending_images[filename] = image
+
+            # The thread is only started once there is something to write
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run)
+                self.thread.daemon = True
+                self.thread.start()
+
+            self.condition.notify_all()
+
+
+    def flush(self):
+        """
+        Wait until every queued image is written.
+        """
+        with self.condition:
+            while len(self.pending_filenames) > 0 or self.writing:
+                self.condition.wait()
+
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while len(self.pending_filenames) == 0:
+                    self.condition.wait()
+
+                filename = self.pending_filenames.popleft()
+                image = self.pending_images.pop(filename)
+                self.writing = True
+
+            try:
+                folder = os.path.dirname(filename)
+                if folder != '' and not os.path.exists(folder):
+                    try:
+                        os.makedirs(folder)
+                    except OSError:
+                        # Created by someone else in the meantime
+                        pass
+
+                with Profiler.stage('encode', path=filename):
+                    written = cv2.imwrite(filename, image)
+                if not written:
+                    print "[ERROR] AsyncImageWriter::write() - Could not write " + filename
+            except Exception as error:
+                print "[ERROR] AsyncImageWriter::write() - Could not write " + filename + ": " + str(error)
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
@@ -0,0 +1,50 @@
+from PyQt4.QtCore import QThread, pyqtSignal
+
+
+class TaskCancelled(Exception):
+    """
+    Raised from a cancelled task's progress callback to stop its work early.
+    """
+    pass
+
+
+class BackgroundTask(QThread):
+    """
+    Runs function(progress_callback) on a worker thread, so the Qt event loop keeps running.
+
+    progress_callback(done, total) emits progress_changed. Once cancel() was called it raises
+    TaskCancelled instead, which stops pyramid based work (see ImageBlender.run_blend) at the
+    next level. Work without progress reports runs to the end, and its result is dropped, so
+    such tasks are created with cancellable False and their owner waits for them instead.
+    The signals are delivered on the thread that owns the task, i.e. the GUI thread.
+    """
+
+    progress_changed = pyqtSignal(int, int)
+    task_finished = pyqtSignal(object)
+    task_failed = pyqtSignal(str)
+
+    def __init__(self, function, parent=None, cancellable=True):
+        QThread.__init__(self, parent)
+        self.function = function
+        self.cancellable = cancellable
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def report_progress(self, done, total):
+        if self.cancelled:
+            raise TaskCancelled()
+        self.progress_changed.emit(done, total)
+
+    def run(self):
+        try:
+            result = self.function(self.report_progress)
+        except TaskCancelled:
+            return
+        except Exception as error:
+            self.task_failed.emit(str(error))
+            return
+
+        if not self.cancelled:
+            self.task_finished.emit(result)
@@ -0,0 +1,309 @@
+from CommandLineExecutor import execute_command
+from ImageAligner import add_arguments as add_aligner_arguments, \
+    options_from_arguments as aligner_options_from_arguments
+from ImageBlender import PRECISIONS, DEFAULT_PRECISION
+from TouristRemovalApp import AppInstance, INTERMEDIATE_OUTPUT_NONE
+from Queue import Queue
+import Profiler
+import argparse
+import shlex
+import threading
+import time
+
+# Pipeline stages in order, and the command types each one runs
+STAGES = ['decode', 'align', 'blend', 'encode']
+STAGE_COMMAND_TYPES = {
+    'decode': ['load'],
+    'align': ['align'],
+    'blend': ['blend', 'median'],
+    'encode': ['save'],
+}
+
+DEFAULT_STAGE_WORKERS = {
+    'decode': 2,
+    'align': 2,
+    'blend': 2,
+    'encode': 1,
+}
+
+# Scenes waiting in front of each stage. With the stage workers this bounds the number of scenes
+# in flight, and so the decoded scenes held in memory: new scenes wait until one finishes.
+DEFAULT_QUEUE_SIZE = 2
+
+
+def read_manifest(manifest_path):
+    """
+    Return the (folder_path, command_script_path) pairs listed in a manifest file.
+
+    Each line names a scene folder and the command script to run on it, separated by spaces.
+    Paths with spaces are quoted. Empty lines and lines starting with '#' are skipped.
+    """
+    scenes = []
+    with open(manifest_path) as manifest_file:
+        for line_number, line in enumerate(manifest_file, 1):
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+
+            parts = shlex.split(line)
+            if len(parts) != 2:
+                print "[ERROR] BatchProcessor::read_manifest() - Line " + str(line_number) + " not properly formatted: (" + line + ")"
+                continue
+
+            scenes.append((parts[0], parts[1]))
+
+    return scenes
+
+
+def read_command_script(script_path, folder_path):
+    """
+    Return the command strings of a command script, one '--cmd ...' per line, with '{folder}'
+    replaced by folder_path. A load of folder_path is added if the script has no load command,
+    so one script can serve every scene.
+    """
+    commands = []
+    with open(script_path) as script_file:
+        for line in script_file:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            commands.append(line.replace('{folder}', folder_path))
+
+    if not any(command.split(' ')[1:2] == ['load'] for command in commands):
+        commands.insert(0, '--cmd load "' + folder_path + '"')
+
+    return commands
+
+
+def command_stage(command):
+    """
+    Return the pipeline stage that runs a parsed command, see STAGE_COMMAND_TYPES.
+    """
+    for stage in STAGES:
+        if command['type'] in STAGE_COMMAND_TYPES[stage]:
+            return stage
+    return None
+
+
+def split_into_stage_runs(commands):
+    """
+    Return the parsed commands as a list of (stage, commands) runs of consecutive commands of the
+    same stage, in script order. Running the runs one after the other runs the script in order.
+    """
+    runs = []
+    for command in commands:
+        stage = command_stage(command)
+        if len(runs) > 0 and runs[-1][0] == stage:
+            runs[-1][1].append(command)
+        else:
+            runs.append((stage, [command]))
+    return runs
+
+
+class Scene:
+    """
+    One scene folder going through the pipeline, with its own headless AppInstance and
+    its parsed commands split into runs of consecutive commands of the same stage.
+    """
+
+    def __init__(self, folder_path, commands, precision=DEFAULT_PRECISION, aligner_options=None):
+        self.folder_path = folder_path
+        self.app_instance = AppInstance(headless=True, intermediate_output=INTERMEDIATE_OUTPUT_NONE,
+                                        precision=precision, aligner_options=aligner_options)
+        self.app_instance.command_line_executor.parse_commands(commands)
+
+        self.stage_runs = split_into_stage_runs(self.app_instance.command_line_executor.command_queue)
+        self.app_instance.command_line_executor.command_queue = []
+        self.next_run = 0
+
+        # Decode every image in the decode stage, so the align stage never waits on a decode
+        for stage, commands in self.stage_runs:
+            if stage == 'decode':
+                for command in commands:
+                    command['parameters']['preload'] = True
+
+        self.failed = False
+        self.stage_times = dict((stage, 0.0) for stage in STAGES)
+
+
+    def next_stage(self):
+        """
+        Return the stage of the next run of commands, or None when the scene is done.
+        """
+        if self.failed or self.next_run == len(self.stage_runs):
+            return None
+        return self.stage_runs[self.next_run][0]
+
+
+class BatchProcessor:
+    """
+    Runs the commands of many scenes as a pipeline: while one scene is blended, the next ones
+    are aligned and decoded and the previous one is encoded.
+
+    Every stage has its own pool of worker threads and a queue of scenes. A scene's commands
+    are split into runs of consecutive commands of the same stage (see STAGE_COMMAND_TYPES),
+    and the scene goes to the stage of each run in script order, so the commands run in the
+    order of the script. A script like 'blend, save, blend, save' goes through the blend and
+    encode stages twice.
+
+    The number of scenes in flight is bounded (see DEFAULT_QUEUE_SIZE), so the queues never
+    fill up and scenes can go back to an earlier stage.
+    """
+
+    def __init__(self, stage_workers=None, queue_size=DEFAULT_QUEUE_SIZE, precision=DEFAULT_PRECISION,
+                 aligner_options=None):
+        """
+        :param stage_workers: dict of the number of worker threads per stage, see DEFAULT_STAGE_WORKERS
+        :param queue_size: number of scenes that can wait in front of each stage. At most
+            queue_size * len(STAGES) scenes plus one per worker are in flight.
+        :param precision: sample type of the blending pyramids, see ImageBlender.PRECISIONS
+        :param aligner_options: dict of ImageAligner constructor arguments of every scene,
+            see ImageAligner.options_from_arguments()
+        """
+        self.stage_workers = dict(DEFAULT_STAGE_WORKERS)
+        if stage_workers is not None:
+            self.stage_workers.update(stage_workers)
+
+        self.queue_size = queue_size
+        self.max_scenes_in_flight = queue_size * len(STAGES) + sum(self.stage_workers.values())
+        self.precision = precision
+        self.aligner_options = aligner_options
+        self.stage_busy_times = dict((stage, 0.0) for stage in STAGES)
+        self.lock = threading.Lock()
+
+
+    def run(self, scenes):
+        """
+        Process the (folder_path, command_script_path) scenes and print a throughput report.
+        Return the number of scenes processed without errors.
+        """
+        # Scenes can go back to an earlier stage, so the queues are unbounded and the number of
+        # scenes in flight is bounded instead. Otherwise stages could block each other.
+        queues = dict((stage, Queue()) for stage in STAGES)
+        finished_queue = Queue()
+        scene_slots = threading.Semaphore(self.max_scenes_in_flight)
+
+        threads = []
+        for stage in STAGES:
+            for worker in range(self.stage_workers[stage]):
+                thread = threading.Thread(target=self.__run_stage, args=(stage, queues, finished_queue, scene_slots))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        start = time.time()
+
+        scene_count = 0
+        for folder_path, script_path in scenes:
+            try:
+                commands = read_command_script(script_path, folder_path)
+            except IOError as error:
+                print "[ERROR] BatchProcessor::run() - Could not read command script " + script_path + ": " + str(error)
+                continue
+
+            scene_slots.acquire()
+            scene = Scene(folder_path, commands, self.precision, self.aligner_options)
+            self.__route_scene(scene, queues, finished_queue, scene_slots)
+            scene_count += 1
+
+        finished_scenes = [finished_queue.get() for scene in range(scene_count)]
+        elapsed = time.time() - start
+
+        for stage in STAGES:
+            for worker in range(self.stage_workers[stage]):
+                queues[stage].put(None)
+        for thread in threads:
+            thread.join()
+
+        succeeded = len([scene for scene in finished_scenes if not scene.failed])
+        self.__print_report(finished_scenes, succeeded, elapsed)
+        return succeeded
+
+
+    def __route_scene(self, scene, queues, finished_queue, scene_slots):
+        """
+        Send a scene to the stage of its next run of commands, or to finished_queue when it is done.
+        """
+        stage = scene.next_stage()
+        if stage is not None:
+            queues[stage].put(scene)
+            return
+
+        # Drop the images, only the report is kept
+        scene.app_instance = None
+        print "[INFO] Finished scene " + scene.folder_path + (" with errors" if scene.failed else "")
+        finished_queue.put(scene)
+        scene_slots.release()
+
+
+    def __run_stage(self, stage, queues, finished_queue, scene_slots):
+        while True:
+            scene = queues[stage].get()
+            if scene is None:
+                return
+
+            commands = scene.stage_runs[scene.next_run][1]
+            scene.next_run += 1
+
+            start = time.time()
+            with Profiler.stage('pipeline', stage=stage, scene=scene.folder_path):
+                self.__run_stage_commands(stage, scene, commands)
+            elapsed = time.time() - start
+            scene.stage_times[stage] += elapsed
+
+            with self.lock:
+                self.stage_busy_times[stage] += elapsed
+
+            self.__route_scene(scene, queues, finished_queue, scene_slots)
+
+
+    def __run_stage_commands(self, stage, scene, commands):
+        for command in commands:
+            try:
+                result = execute_command(command)
+            except Exception as error:
+                print "[ERROR] BatchProcessor::run() - " + stage + " of " + scene.folder_path + " failed: " + str(error)
+                scene.failed = True
+                return
+
+            # load and save report failure by returning False
+            if result is False:
+                print "[ERROR] BatchProcessor::run() - " + command['type'] + " of " + scene.folder_path + " failed"
+                scene.failed = True
+                return
+
+
+    def __print_report(self, finished_scenes, succeeded, elapsed):
+        print "[INFO] Processed %d scenes (%d failed) in %.1fs: %.2f scenes/min" % \
+            (len(finished_scenes), len(finished_scenes) - succeeded, elapsed,
+             len(finished_scenes) * 60.0 / elapsed if elapsed > 0 else 0)
+
+        for stage in STAGES:
+            workers = self.stage_workers[stage]
+            utilization = self.stage_busy_times[stage] / (elapsed * workers) if elapsed > 0 else 0
+            print "[INFO]   %-6s %d workers, %7.1fs busy, %3d%% utilization" % \
+                (stage, workers, self.stage_busy_times[stage], utilization * 100)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run command scripts on many scene folders as a pipeline.")
+    parser.add_argument('manifest', help="file with one 'scene_folder command_script' pair per line")
+    for stage in STAGES:
+        parser.add_argument('--' + stage + '-workers', type=int, default=DEFAULT_STAGE_WORKERS[stage],
+                            help="worker threads of the " + stage + " stage (default %(default)s)")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="scenes waiting in front of each stage (default %(default)s)")
+    parser.add_argument('--precision', choices=PRECISIONS, default=DEFAULT_PRECISION,
+                        help="sample type of the blending pyramids (default %(default)s)")
+    add_aligner_arguments(parser)
+    Profiler.add_arguments(parser)
+    arguments = parser.parse_args()
+
+    profiler = Profiler.start_from_arguments(arguments)
+
+    stage_workers = dict((stage, getattr(arguments, stage + '_workers')) for stage in STAGES)
+    batch_processor = BatchProcessor(stage_workers, arguments.queue_size, arguments.precision,
+                                     aligner_options_from_arguments(arguments))
+    batch_processor.run(read_manifest(arguments.manifest))
+
+    Profiler.stop_and_write(profiler, arguments)
@@ -0,0 +1,250 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+import ImageAligner
+import ImageBlender
+from ImageMask import ImageMask
+from ImageSource import ImageSource
+from TouristRemovalApp import AppInstance, INTERMEDIATE_OUTPUT_NONE
+import Profiler
+
+DATASETS = ["./test1", "./sailboat", "./sources"]
+
+# Every dataset is also benchmarked upscaled by these factors, to see how the stages scale
+# to camera resolutions
+SCALES = [1, 2]
+
+BENCHMARKS = ['find_matches_between_images', 'find_homography', 'warpImagePair', 'reduce', 'expand',
+              'laplPyramid', 'collapse', 'ImageBlender.blend', 'end_to_end']
+
+REPEATS = 3
+
+# A benchmark regresses when it gets this much slower, or uses this much more memory, than the baseline
+DEFAULT_THRESHOLD = 0.10
+
+
+def upscale(image, scale):
+    if scale == 1:
+        return image
+    return cv2.resize(image, (image.shape[1] * scale, image.shape[0] * scale), interpolation=cv2.INTER_CUBIC)
+
+
+def center_rectangle(shape):
+    """
+    Return (x, y, width, height) of a rectangle over the center ninth of an image of 'shape'.
+    """
+    return (shape[1] // 3, shape[0] // 3, shape[1] // 3, shape[0] // 3)
+
+
+def write_upscaled_dataset(dataset, scale, folder):
+    """
+    Write the images of dataset upscaled by scale to folder, under the same file names.
+    """
+    for filename in os.listdir(dataset):
+        image = cv2.imread(os.path.join(dataset, filename))
+        if image is not None:
+            cv2.imwrite(os.path.join(folder, filename), upscale(image, scale), [cv2.IMWRITE_JPEG_QUALITY, 95])
+
+
+def setup_benchmark(name, dataset, scale, work_folder):
+    """
+    Prepare the inputs of benchmark 'name' and return (function, megapixels): calling function()
+    runs what is timed, megapixels is the image size it processes. Setup work is not timed.
+    Files the benchmark needs are written to work_folder.
+    """
+    image_source = ImageSource()
+    if not image_source.load_images(dataset):
+        raise IOError("Could not load images from " + dataset)
+
+    primary_image = upscale(image_source.get_primary_image(), scale)
+    secondary_image = upscale(image_source.get_secondary_image(0), scale)
+    megapixels = primary_image.shape[0] * primary_image.shape[1] / 1e6
+
+    if name == 'find_matches_between_images':
+        return lambda: ImageAligner.find_matches_between_images(secondary_image, primary_image, 50), megapixels
+
+    if name in ('find_homography', 'warpImagePair'):
+        secondary_kp, primary_kp, matches = ImageAligner.find_matches_between_images(secondary_image, primary_image, 50)
+        if name == 'find_homography':
+            return lambda: ImageAligner.find_homography(secondary_kp, primary_kp, matches), megapixels
+
+        homography = ImageAligner.find_homography(secondary_kp, primary_kp, matches)
+        return lambda: ImageAligner.warpImagePair(secondary_image, primary_image, homography), megapixels
+
+    image = primary_image.astype(np.float32)
+    depth = ImageBlender.pyramid_depth(image.shape)
+
+    if name == 'reduce':
+        return lambda: ImageBlender.reduce(image), megapixels
+
+    if name == 'expand':
+        return lambda: ImageBlender.expand(image), megapixels
+
+    if name == 'laplPyramid':
+        gauss_pyramid = ImageBlender.gaussPyramid(image, depth)
+        return lambda: ImageBlender.laplPyramid(gauss_pyramid), megapixels
+
+    if name == 'collapse':
+        lapl_pyramid = ImageBlender.laplPyramid(ImageBlender.gaussPyramid(image, depth))
+        return lambda: ImageBlender.collapse(lapl_pyramid), megapixels
+
+    if name == 'ImageBlender.blend':
+        # Without pyramid cache, every repeat blends from scratch
+        image_blender = ImageBlender.ImageBlender(pyramid_cache_max_bytes=0)
+        mask = ImageMask(primary_image.shape).add_rectangle(*center_rectangle(primary_image.shape))
+        return lambda: image_blender.blend(primary_image, secondary_image, mask), megapixels
+
+    if name == 'end_to_end':
+        write_upscaled_dataset(dataset, scale, work_folder)
+        commands = [
+            '--cmd load "' + work_folder + '"',
+            '--cmd align 0',
+            '--cmd blend 0 %d %d %d %d' % center_rectangle(primary_image.shape),
+            '--cmd save "' + os.path.join(work_folder, "result.jpg") + '"',
+        ]
+        return lambda: AppInstance(True, INTERMEDIATE_OUTPUT_NONE).run_as_commandline_app(commands), megapixels
+
+    raise ValueError("Unknown benchmark '%s'" % name)
+
+
+def run_benchmark(name, dataset, scale, repeats, result_queue):
+    """
+    Time benchmark 'name' and put its result dict on result_queue. Meant to run in its own
+    process, so the peak RSS is the benchmark's own and not that of earlier ones.
+    """
+    work_folder = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        function, megapixels = setup_benchmark(name, dataset, scale, work_folder)
+
+        timings = []
+        for repeat in range(repeats):
+            start = time.time()
+            function()
+            timings.append(time.time() - start)
+
+        peak_rss_mb = Profiler.peak_rss_mb()
+
+        result_queue.put({
+            'benchmark': name,
+            'dataset': dataset,
+            'scale': scale,
+            'megapixels': round(megapixels, 3),
+            'repeats': repeats,
+            'best_seconds': min(timings),
+            'mean_seconds': sum(timings) / len(timings),
+            'peak_rss_mb': round(peak_rss_mb, 1),
+            'megapixels_per_second': megapixels / min(timings) if min(timings) > 0 else None,
+        })
+    except Exception as error:
+        result_queue.put({'benchmark': name, 'dataset': dataset, 'scale': scale, 'error': str(error)})
+    finally:
+        shutil.rmtree(work_folder, True)
+
+
+def run_suite(datasets, scales, benchmarks, repeats):
+    """
+    Run every benchmark on every dataset at every scale, each in a fresh process.
+    Return the results as a dict ready to be dumped to JSON.
+    """
+    results = []
+
+    for dataset in datasets:
+        for scale in scales:
+            for name in benchmarks:
+                result_queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target=run_benchmark, args=(name, dataset, scale, repeats, result_queue))
+                process.start()
+                process.join()
+
+                # A crashed benchmark leaves no result
+                if result_queue.empty():
+                    result = {'benchmark': name, 'dataset': dataset, 'scale': scale,
+                              'error': "process exited with code %d" % process.exitcode}
+                else:
+                    result = result_queue.get()
+
+                if 'error' in result:
+                    print "[ERROR] BenchmarkSuite - %s on %s x%d failed: %s" % (name, dataset, scale, result['error'])
+                else:
+                    print "%-30s %-12s x%d %6.2fMP %10.1fms %8.1fMB %8.2fMP/s" % \
+                        (name, dataset, scale, result['megapixels'], result['best_seconds'] * 1000,
+                         result['peak_rss_mb'], result['megapixels_per_second'] or 0)
+                results.append(result)
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'cpu_count': multiprocessing.cpu_count(),
+            'convolution_backend': ImageBlender.CONVOLUTION_BACKEND,
+        },
+        'results': results,
+    }
+
+
+def compare_with_baseline(report, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Print how every result compares with the same benchmark, dataset and scale in baseline.
+    Return the number of regressions: results more than 'threshold' slower, or with that much
+    higher peak RSS, than the baseline.
+    """
+    baseline_results = dict(((result['benchmark'], result['dataset'], result['scale']), result)
+                            for result in baseline['results'] if 'error' not in result)
+
+    regressions = 0
+    for result in report['results']:
+        key = (result['benchmark'], result['dataset'], result['scale'])
+        if 'error' in result or key not in baseline_results:
+            continue
+
+        time_ratio = result['best_seconds'] / baseline_results[key]['best_seconds']
+        rss_ratio = result['peak_rss_mb'] / baseline_results[key]['peak_rss_mb']
+
+        status = "ok"
+        if time_ratio > 1 + threshold or rss_ratio > 1 + threshold:
+            status = "REGRESSION"
+            regressions += 1
+        elif time_ratio < 1 - threshold:
+            status = "faster"
+
+        print "%-30s %-12s x%d  time %5.2fx  rss %5.2fx  %s" % (key + (time_ratio, rss_ratio, status))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the align, blend and end to end stages.")
+    parser.add_argument('--datasets', nargs='+', default=DATASETS)
+    parser.add_argument('--scales', nargs='+', type=int, default=SCALES,
+                        help="upscale factors of the datasets (default %(default)s)")
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--output', default="benchmark-results.json", help="JSON report (default %(default)s)")
+    parser.add_argument('--baseline', help="JSON report of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown or memory growth that counts as a regression (default %(default)s)")
+    arguments = parser.parse_args()
+
+    report = run_suite(arguments.datasets, arguments.scales, arguments.benchmarks, arguments.repeats)
+
+    with open(arguments.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2, sort_keys=True)
+    print "[INFO] Wrote " + arguments.output
+
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = compare_with_baseline(report, baseline, arguments.threshold)
+        if regressions > 0:
+            print "[ERROR] BenchmarkSuite - %d regressions against %s" % (regressions, arguments.baseline)
+            sys.exit(1)
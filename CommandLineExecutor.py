@@ -1,6 +1,82 @@
 from ImageAligner import ImageAligner
 from ImageBlender import ImageBlender
 from ImageSource import ImageSource
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+import multiprocessing
+import Profiler
+import sys
+
+# Resource names of the state commands read and write, see command_resources().
+# ('aligned', ALL_IMAGES) stands for the aligned version of every secondary image.
+ALL_IMAGES = '*'
+
+def execute_command(command):
+    """
+    Run a command parsed by CommandLineExecutor.parse_commands() and return what its method returns.
+    """
+    with Profiler.stage('command', type=command['type']):
+        return command['method'](**command['parameters'])
+
+
+def command_resources(command):
+    """
+    Return (reads, writes), the sets of resources a parsed command reads and writes:
+        'source'            - the loaded primary and secondary images
+        ('aligned', index)  - an aligned secondary image, index ALL_IMAGES for all of them
+        'result'            - the result image
+        ('file', filename)  - a saved file
+    """
+    parameters = command['parameters']
+
+    if command['type'] == 'load':
+        return set(), set(['source', ('aligned', ALL_IMAGES), 'result'])
+
+    if command['type'] == 'align':
+        index = parameters.get('secondary_image_index', ALL_IMAGES)
+        return set(['source']), set([('aligned', index)])
+
+    if command['type'] == 'blend':
+        return set(['source', ('aligned', parameters['secondary_image_index']), 'result']), set(['result'])
+
+    if command['type'] == 'median':
+        # Aligns the secondary images that are not aligned yet
+        return set(['source', ('aligned', ALL_IMAGES)]), set([('aligned', ALL_IMAGES), 'result'])
+
+    if command['type'] == 'save':
+        return set(['result']), set([('file', parameters['filename'])])
+
+    # Unknown commands conflict with everything
+    return set(), set(['source', ('aligned', ALL_IMAGES), 'result'])
+
+
+def resources_overlap(resources, other_resources):
+    for resource in resources:
+        for other_resource in other_resources:
+            if resource == other_resource:
+                return True
+            if isinstance(resource, tuple) and isinstance(other_resource, tuple) and \
+                    resource[0] == other_resource[0] == 'aligned' and ALL_IMAGES in (resource[1], other_resource[1]):
+                return True
+    return False
+
+
+def build_dependency_graph(commands):
+    """
+    Return, for every command, the indices of the earlier commands it has to wait for:
+    those that write something it reads or writes, or read something it writes.
+    Running every command after its dependencies gives the same result as running them in order.
+    """
+    resources = [command_resources(command) for command in commands]
+
+    dependencies = []
+    for index, (reads, writes) in enumerate(resources):
+        dependencies.append([earlier for earlier, (earlier_reads, earlier_writes) in enumerate(resources[:index])
+                             if resources_overlap(earlier_writes, reads | writes) or
+                             resources_overlap(earlier_reads, writes)])
+
+    return dependencies
+
 
 class CommandLineExecutor:
     """
@@ -24,12 +100,24 @@ class CommandLineExecutor:
             '--cmd align 2'
                 Aligns secondary image (with provided index) with primary image.
 
+            '--cmd align all [workers]'
+                Aligns every secondary image with primary image, in parallel.
+                Parameters: optional number of workers (defaults to the number of cores)
+
             '--cmd blend 2 10 20 120 300'
                 Blends region of secondary image (with provided index) into primary image.
                 Parameters: index x y width height
 
+            '--cmd median [workers]'
+                Replaces the result by the per-pixel median of the primary and all secondary images,
+                aligning the secondary images that are not aligned yet.
+                Parameters: optional number of alignment workers (defaults to the number of cores)
+
             '--cmd save "path/to/result_filename.ext"'
                 Saves primary image at specified location.
+
+        Each queued command is a dict with the 'type' of the command ('load', 'align', 'blend', 'median' or 'save'),
+        the bound 'method' to call and its keyword 'parameters'.
         """
 
         for command_str in commands:
@@ -54,11 +142,26 @@ class CommandLineExecutor:
 
                 folder_path = command_parameters[0].replace('"', '').strip()
 
+                command['type'] = 'load'
                 command['method'] = self.app_instance.image_source.load_images
                 command['parameters'] = {
                     'folder_path': folder_path
                 }
 
+            elif command_type == 'align' and len(command_parameters) > 0 and command_parameters[0].lower() == 'all':
+                # Check number of parameters
+                if len(command_parameters) > 2:
+                    print "[ERROR] CommandLineExecutor::parse_commands() - Command not properly formatted: (" + command_str + ")"
+                    continue
+
+                num_workers = int(command_parameters[1]) if len(command_parameters) == 2 else None
+
+                command['type'] = 'align'
+                command['method'] = self.app_instance.align_all
+                command['parameters'] = {
+                    'num_workers': num_workers
+                }
+
             elif command_type == 'align':
                 # Check number of parameters
                 if len(command_parameters) != 1:
@@ -67,6 +170,7 @@ class CommandLineExecutor:
 
                 secondary_image_index = int(command_parameters[0])
 
+                command['type'] = 'align'
                 command['method'] = self.app_instance.align_nth_secondary_image
                 command['parameters'] = {
                     'secondary_image_index': secondary_image_index
@@ -84,6 +188,7 @@ class CommandLineExecutor:
                 width = int(command_parameters[3])
                 height = int(command_parameters[4])
 
+                command['type'] = 'blend'
                 command['method'] = self.app_instance.blend_nth_secondary_image
                 command['parameters'] = {
                     'secondary_image_index': secondary_image_index,
@@ -93,6 +198,20 @@ class CommandLineExecutor:
                     'height': height
                 }
 
+            elif command_type == 'median':
+                # Check number of parameters
+                if len(command_parameters) > 1:
+                    print "[ERROR] CommandLineExecutor::parse_commands() - Command not properly formatted: (" + command_str + ")"
+                    continue
+
+                num_workers = int(command_parameters[0]) if len(command_parameters) == 1 else None
+
+                command['type'] = 'median'
+                command['method'] = self.app_instance.median_all_images
+                command['parameters'] = {
+                    'num_workers': num_workers
+                }
+
             elif command_type == 'save':
                 # Check number of parameters
                 if len(command_parameters) != 1:
@@ -101,6 +220,7 @@ class CommandLineExecutor:
 
                 filename = command_parameters[0].replace('"', '').strip()
 
+                command['type'] = 'save'
                 command['method'] = self.app_instance.save_result
                 command['parameters'] = {
                     'filename': filename
@@ -128,10 +248,81 @@ class CommandLineExecutor:
         print "[INFO] Processing command..."
 
         command = self.command_queue.pop(0)
-        command['method'](**command['parameters'])
+        execute_command(command)
 
         # Return true if there are more commands left to process
         if len(self.command_queue) > 0:
             return True
 
         return False
+
+
+    def execute_all_commands(self, num_workers=None):
+        """
+        Execute every queued command on a pool of num_workers threads (defaults to the number of cores).
+
+        Commands start as soon as the commands they depend on are done (see build_dependency_graph()),
+        so aligns of different images run concurrently while the blends still update the result image
+        one after the other, in queue order. The result is the same as with execute_next_command().
+        If a command raises, no further commands are started and the exception is raised again once
+        the running ones are done.
+        """
+        commands = self.command_queue
+        self.command_queue = []
+
+        if len(commands) == 0:
+            print "[ERROR] CommandLineExecutor::execute_all_commands() - No commands in queue."
+            return
+
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+
+        dependencies = build_dependency_graph(commands)
+        dependents = [[] for command in commands]
+        for index, command_dependencies in enumerate(dependencies):
+            for dependency in command_dependencies:
+                dependents[dependency].append(index)
+        remaining_dependencies = [len(command_dependencies) for command_dependencies in dependencies]
+
+        finished_queue = Queue()
+
+        def run(index):
+            try:
+                execute_command(commands[index])
+                finished_queue.put((index, None))
+            except Exception:
+                finished_queue.put((index, sys.exc_info()))
+
+        pool = ThreadPool(num_workers)
+        running = 0
+        error = None
+
+        try:
+            for index in range(len(commands)):
+                if remaining_dependencies[index] == 0:
+                    print "[INFO] Processing command..."
+                    pool.apply_async(run, (index,))
+                    running += 1
+
+            while running > 0:
+                index, command_error = finished_queue.get()
+                running -= 1
+
+                if command_error is not None:
+                    print "[ERROR] CommandLineExecutor::execute_all_commands() - Command failed: " + str(command_error[1])
+                    error = error or command_error
+                if error is not None:
+                    continue
+
+                for dependent in dependents[index]:
+                    remaining_dependencies[dependent] -= 1
+                    if remaining_dependencies[dependent] == 0:
+                        print "[INFO] Processing command..."
+                        pool.apply_async(run, (dependent,))
+                        running += 1
+        finally:
+            pool.close()
+            pool.join()
+
+        if error is not None:
+            raise error[0], error[1], error[2]
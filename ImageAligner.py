@@ -1,5 +1,7 @@
 import numpy as np
 import cv2
+from LruCache import LruCache, image_digest
+import Profiler
 
 try:
     from cv2 import ORB as SIFT
@@ -18,19 +20,102 @@ def get_image_corners(image):
     return np.array([[[0, 0]], [[0, image.shape[0]]], [[image.shape[1], 0]], [[image.shape[1], image.shape[0]]]], dtype=np.float32)
 
 
-def find_matches_between_images(image_1, image_2, num_matches):
+# Descriptor matching engines for match_descriptors()
+#   'bruteforce' - cross-checked brute force Hamming matching
+#   'flann'      - FLANN LSH index, 2 nearest neighbours and ratio test
+#   'ratio'      - brute force 2 nearest neighbours and ratio test
+MATCHERS = ('bruteforce', 'flann', 'ratio')
+
+FLANN_INDEX_LSH = 6
+
+
+def create_detector(num_features=None):
+    """
+    Return a feature detector. num_features overrides the detector's default number of features.
+    """
+    if num_features is None:
+        return SIFT()
+    return SIFT(nfeatures=num_features)
+
+
+def detect_features(image, feature_cache=None, num_features=None):
+    """
+    Return the keypoints and descriptors of image.
+    If a feature_cache (LruCache) is given, images with the same contents are only detected once.
+    """
+    if feature_cache is None:
+        with Profiler.stage('detect'):
+            return create_detector(num_features).detectAndCompute(image, None)
+
+    key = (image_digest(image), num_features)
+    features = feature_cache.get(key)
+    if features is None:
+        with Profiler.stage('detect'):
+            features = create_detector(num_features).detectAndCompute(image, None)
+        feature_cache.put(key, features)
+
+    return features
+
+
+def match_descriptors(image_1_desc, image_2_desc, matcher='bruteforce', ratio=0.75):
+    """
+    Return the list of cv2.DMatch between two sets of binary descriptors, using one of MATCHERS.
+    The kNN matchers keep a match only if it is closer than 'ratio' times the second best one.
+    """
+    if image_1_desc is None or image_2_desc is None:
+        return []
+
+    if matcher == 'bruteforce':
+        return cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(image_1_desc, image_2_desc)
+
+    if matcher == 'flann':
+        index_params = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+        knn_matches = cv2.FlannBasedMatcher(index_params, dict(checks=50)).knnMatch(image_1_desc, image_2_desc, k=2)
+    elif matcher == 'ratio':
+        knn_matches = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(image_1_desc, image_2_desc, k=2)
+    else:
+        raise ValueError("Unknown matcher '%s', expected one of %s" % (matcher, ', '.join(MATCHERS)))
+
+    # LSH may find fewer than 2 neighbours for some descriptors
+    return [pair[0] for pair in knn_matches
+            if len(pair) == 1 or (len(pair) == 2 and pair[0].distance < ratio * pair[1].distance)]
+
+
+def select_best_matches(matches, num_matches):
+    """
+    Return the num_matches matches with the smallest distance, ordered by distance.
+
+    Same result as sorted(matches, key=distance)[:num_matches], ties included, but only the
+    selected matches are sorted: the rest is split off with np.partition.
+    """
+    if len(matches) <= num_matches:
+        return sorted(matches, key=lambda x: x.distance)
+
+    distances = np.array([match.distance for match in matches])
+    threshold = np.partition(distances, num_matches - 1)[num_matches - 1]
+
+    # Everything strictly below the threshold, then ties in their original order, like a stable sort
+    below = np.nonzero(distances < threshold)[0]
+    ties = np.nonzero(distances == threshold)[0][:num_matches - len(below)]
+    selected = np.concatenate((below, ties))
+    selected = selected[np.argsort(distances[selected], kind='mergesort')]
+
+    return [matches[index] for index in selected]
+
+
+def find_matches_between_images(image_1, image_2, num_matches, feature_cache=None, matcher='bruteforce',
+                                num_features=None):
     matches = None
     image_1_kp = None
     image_1_desc = None
     image_2_kp = None
     image_2_desc = None
 
-    image_1_kp, image_1_desc = SIFT().detectAndCompute( image_1, None )
-    image_2_kp, image_2_desc = SIFT().detectAndCompute( image_2, None )
-    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-    matches = bf.match(image_1_desc, image_2_desc)
-    matches = sorted(matches, key = lambda x:x.distance)
-    return image_1_kp, image_2_kp, matches[:num_matches]
+    image_1_kp, image_1_desc = detect_features(image_1, feature_cache, num_features)
+    image_2_kp, image_2_desc = detect_features(image_2, feature_cache, num_features)
+    with Profiler.stage('match', matcher=matcher):
+        matches = select_best_matches(match_descriptors(image_1_desc, image_2_desc, matcher), num_matches)
+    return image_1_kp, image_2_kp, matches
 
 
 def find_homography(image_1_kp, image_2_kp, matches):
@@ -39,36 +124,106 @@ def find_homography(image_1_kp, image_2_kp, matches):
     for match_idx, match in enumerate(matches):
         image_1_points[match_idx] = image_1_kp[match.queryIdx].pt
         image_2_points[match_idx] = image_2_kp[match.trainIdx].pt
-    return cv2.findHomography(image_1_points, image_2_points, method=cv2.RANSAC, ransacReprojThreshold=5.0)[0]
+    with Profiler.stage('homography'):
+        return cv2.findHomography(image_1_points, image_2_points, method=cv2.RANSAC, ransacReprojThreshold=5.0)[0]
+
+
+def downscale_image(image, levels):
+    """
+    Return image reduced by 2 'levels' times with cv2.pyrDown (a level of its Gaussian pyramid).
+    """
+    for level in range(levels):
+        image = cv2.pyrDown(image)
+    return image
+
 
+def scale_homography(homography, scale):
+    """
+    Convert a homography estimated between images resized by 'scale' to one between the
+    original images.
+    """
+    scale_matrix = np.diag([scale, scale, 1.0])
+    return np.dot(np.dot(np.linalg.inv(scale_matrix), homography), scale_matrix)
 
-def warpImagePair(image_1, image_2, homography):
-    warped_image = None
-    x_min = 0
-    y_min = 0
-    x_max = 0
-    y_max = 0
 
-    image_1_corners = get_image_corners(image_1)
-    image_2_corners = get_image_corners(image_2)
+def refine_homography_ecc(image_1, image_2, homography, iterations, epsilon=1e-4):
+    """
+    Refine a homography mapping image_1 onto image_2 with a few iterations of ECC image
+    alignment (cv2.findTransformECC) on the grayscale images.
+    Return the input homography if ECC is not available or does not converge.
+    """
+    if not hasattr(cv2, 'findTransformECC'):
+        print "[WARNING] refine_homography_ecc() - OpenCV(%s) has no findTransformECC" % cv2.__version__
+        return homography
 
-    image_1_corners = cv2.perspectiveTransform(image_1_corners, homography)
-    corners = np.concatenate((image_1_corners, image_2_corners))
+    gray_1 = cv2.cvtColor(image_1, cv2.COLOR_BGR2GRAY) if image_1.ndim == 3 else image_1
+    gray_2 = cv2.cvtColor(image_2, cv2.COLOR_BGR2GRAY) if image_2.ndim == 3 else image_2
 
-    x_min = min(corners[:, 0, 0])
-    x_max = max(corners[:, 0, 0])
-    y_min = min(corners[:, 0, 1])
-    y_max = max(corners[:, 0, 1])
+    # ECC warps its input image onto its template, i.e. it estimates the template -> input mapping.
+    warp_matrix = np.linalg.inv(homography).astype(np.float32)
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, iterations, epsilon)
 
-    translation_matrix = np.array([[1, 0, -1 * x_min], [0, 1, -1 * y_min], [0, 0, 1]])
-    translated_homography = np.dot(translation_matrix, homography)
+    try:
+        try:
+            warp_matrix = cv2.findTransformECC(gray_2, gray_1, warp_matrix, cv2.MOTION_HOMOGRAPHY, criteria)[1]
+        except TypeError:
+            # Some OpenCV 4 bindings require the input mask and Gaussian filter size
+            warp_matrix = cv2.findTransformECC(gray_2, gray_1, warp_matrix, cv2.MOTION_HOMOGRAPHY, criteria,
+                                               None, 1)[1]
+    except cv2.error:
+        print "[WARNING] refine_homography_ecc() - ECC did not converge, keeping the initial homography"
+        return homography
+
+    return np.linalg.inv(warp_matrix.astype(np.float64))
 
-    warped_image_1 = cv2.warpPerspective(image_1, translated_homography, (x_max - x_min, y_max - y_min))
 
-    # Select a sub-region of the warped image that matches image_2's (primary image's) coordinate frame
-    warped_image_1 = warped_image_1[-y_min:-y_min+image_2.shape[0], -x_min:-x_min+image_2.shape[1]]
+def warpImagePair(image_1, image_2, homography, return_mask=False):
+    """
+    Warp image_1 with homography straight into image_2's (primary image's) coordinate frame.
 
-    return warped_image_1
+    Only image_2's pixels are computed, so time and memory are bounded by its size however
+    far the homography moves image_1's corners.
+    If return_mask is set, also return a uint8 mask that is 255 where the warped image has
+    pixels from image_1 and 0 elsewhere.
+    """
+    size = (image_2.shape[1], image_2.shape[0])
+    with Profiler.stage('warp'):
+        warped_image_1 = cv2.warpPerspective(image_1, homography, size)
+
+        if not return_mask:
+            return warped_image_1
+
+        valid_mask = cv2.warpPerspective(np.full(image_1.shape[:2], 255, dtype=np.uint8), homography, size,
+                                         flags=cv2.INTER_NEAREST)
+    return warped_image_1, valid_mask
+
+
+def add_arguments(parser):
+    """
+    Add the ImageAligner options (--coarse-level, --refine-iterations, --matcher, --num-features)
+    to an argparse parser.
+    """
+    parser.add_argument('--coarse-level', type=int, default=0,
+                        help="detect features on images downscaled by 2**level, decoded at that scale when "
+                             "possible (default %(default)s)")
+    parser.add_argument('--refine-iterations', type=int, default=0,
+                        help="ECC iterations refining coarse homographies at full resolution (default %(default)s)")
+    parser.add_argument('--matcher', choices=MATCHERS, default='bruteforce',
+                        help="descriptor matching engine (default %(default)s)")
+    parser.add_argument('--num-features', type=int, default=None,
+                        help="features to detect per image (default: the detector's)")
+
+
+def options_from_arguments(arguments):
+    """
+    Return the ImageAligner constructor arguments set by the add_arguments() options.
+    """
+    return {
+        'coarse_level': arguments.coarse_level,
+        'refine_iterations': arguments.refine_iterations,
+        'matcher': arguments.matcher,
+        'num_features': arguments.num_features,
+    }
 
 
 class ImageAligner:
@@ -77,17 +232,74 @@ class ImageAligner:
     Handles aligning images using feature detection and image transformation.
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, feature_cache_size=16, coarse_level=0, refine_iterations=0, matcher='bruteforce',
+                 num_features=None):
+        """
+        :param feature_cache_size: number of images whose keypoints and descriptors are kept,
+            so aligning several secondaries against one primary detects the primary once.
+        :param coarse_level: detect and match features on this level of the images' pyramids,
+            i.e. on images downscaled by 2 ** coarse_level. 0 uses the full resolution images.
+        :param refine_iterations: if > 0, refine the homography with this many ECC iterations
+            on the full resolution images.
+        :param matcher: descriptor matching engine, one of MATCHERS.
+        :param num_features: number of features to detect per image, None for the detector's default.
+            Hard scenes may need more; 'flann' and 'ratio' scale better than 'bruteforce' then.
+        """
+        self.feature_cache = LruCache(max_entries=feature_cache_size)
+        self.coarse_level = coarse_level
+        self.refine_iterations = refine_iterations
+        self.matcher = matcher
+        self.num_features = num_features
+
+    def precompute_features(self, image, coarse_image=None):
+        """
+        Detect and cache the features of image, e.g. a primary image that several secondary
+        images are about to be aligned against concurrently.
+        With coarse_level > 0, pass the coarse image that estimate_homography() will get as
+        coarse_primary_image, as features are cached by image contents. It defaults to
+        downscale_image() of image, as in estimate_homography().
+        """
+        if coarse_image is None:
+            coarse_image = downscale_image(image, self.coarse_level)
+        detect_features(coarse_image, self.feature_cache, self.num_features)
+
+    def estimate_homography(self, primary_image, secondary_image, coarse_primary_image=None,
+                            coarse_secondary_image=None):
+        """
+        Return the homography that maps the secondary image onto the primary image.
+        With coarse_level > 0, the coarse images are the ones features are detected on. They default
+        to downscale_image() of the full images; pass them to reuse images decoded at that scale.
+        """
+        if coarse_primary_image is None:
+            coarse_primary_image = downscale_image(primary_image, self.coarse_level)
+        if coarse_secondary_image is None:
+            coarse_secondary_image = downscale_image(secondary_image, self.coarse_level)
+
+        secondary_kp, primary_kp, matches = find_matches_between_images(
+            coarse_secondary_image, coarse_primary_image,
+            50, self.feature_cache, self.matcher, self.num_features)
+        homography = find_homography(secondary_kp, primary_kp, matches)
 
-    def align_image(self, primary_image, secondary_image):
+        if self.coarse_level > 0:
+            homography = scale_homography(homography, 0.5 ** self.coarse_level)
+
+        if self.refine_iterations > 0:
+            homography = refine_homography_ecc(secondary_image, primary_image, homography, self.refine_iterations)
+
+        return homography
+
+    def align_image(self, primary_image, secondary_image, return_mask=False, coarse_primary_image=None,
+                    coarse_secondary_image=None):
         """
         Transform the secondary image to be aligned to the primary image.
         :param primary_image:
         :param secondary_image:
+        :param return_mask: also return the mask of pixels covered by the secondary image
+        :param coarse_primary_image: see estimate_homography()
+        :param coarse_secondary_image: see estimate_homography()
         """
-        secondary_kp, primary_kp, matches = find_matches_between_images(secondary_image, primary_image, 50)
-        homography = find_homography(secondary_kp, primary_kp, matches)
-        warped = warpImagePair(secondary_image, primary_image, homography)
+        homography = self.estimate_homography(primary_image, secondary_image, coarse_primary_image,
+                                              coarse_secondary_image)
+        warped = warpImagePair(secondary_image, primary_image, homography, return_mask)
 
         return warped
\ No newline at end of file
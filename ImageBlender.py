@@ -1,5 +1,6 @@
 import numpy as np
 import scipy as sp
+import scipy.ndimage
 import scipy.signal
 import sys
 import os
@@ -7,6 +8,8 @@ import cv2
 from scipy.stats import norm
 from scipy.signal import convolve2d
 import math
+from LruCache import LruCache, image_digest
+import Profiler
 
 def generatingKernel(parameter):
   """ Return a 5x5 generating kernel based on an input parameter.
@@ -25,83 +28,187 @@ def generatingKernel(parameter):
   return np.outer(kernel, kernel)
 
 
-def reduce(image):
-    """ Convolve the input image with a generating kernel of parameter of 0.4 and
-    then reduce its width and height by two.
+# Convolution backend used by reduce() and expand(). One of CONVOLUTION_BACKENDS.
+#   'numpy' - pure NumPy separable passes that only compute the kept samples.
+#   'scipy' - scipy.ndimage.correlate1d separable passes.
+#   'cv2'   - cv2.sepFilter2D.
+CONVOLUTION_BACKENDS = ('numpy', 'scipy', 'cv2')
+CONVOLUTION_BACKEND = 'cv2'
 
-    Please consult the lectures and readme for a more in-depth discussion of how
-    to tackle the reduce function.
 
-    You can use any / all functions to convolve and reduce the image, although
-    the lectures have recommended methods that we advise since there are a lot
-    of pieces to this assignment that need to work 'just right'.
+def set_convolution_backend(backend):
+    """ Select the convolution backend used by reduce() and expand().
 
     Args:
-    image (numpy.ndarray): a grayscale image of shape (r, c)
+      backend (str): One of CONVOLUTION_BACKENDS.
+    """
+    global CONVOLUTION_BACKEND
 
-    Returns:
-    output (numpy.ndarray): an image of shape (ceil(r/2), ceil(c/2))
-      For instance, if the input is 5x7, the output will be 3x4.
+    if backend not in CONVOLUTION_BACKENDS:
+        raise ValueError("Unknown convolution backend '%s', expected one of %s"
+                         % (backend, ', '.join(CONVOLUTION_BACKENDS)))
+
+    CONVOLUTION_BACKEND = backend
+
+
+def generatingKernel1D(parameter):
+  """ Return the 1-D factor of generatingKernel(parameter).
+
+  generatingKernel(parameter) == np.outer(k, k) where k is this vector, so the
+  5x5 convolution can be done as two 5-tap passes (10 multiply-adds per pixel
+  instead of 25).
+  """
+  return np.array([0.25 - parameter / 2.0, 0.25, parameter,
+                   0.25, 0.25 - parameter /2.0])
+
+
+def _working_dtype(image):
+    """ Floating point type the pyramid functions compute in for 'image'. """
+    if image.dtype.kind == 'f':
+        return image.dtype
+    return np.dtype(np.float64)
 
+
+def _reduce_rows(image, kernel):
+    """ Filter along the first axis with zero padding, keeping only the even
+    output rows. Only the kept rows are computed.
     """
+    rowCount = image.shape[0]
+    keptCount = (rowCount + 1) // 2
 
-    kernel = generatingKernel(0.4)
-    convolvedImage = sp.signal.convolve2d(image, kernel, 'same')
+    padded = np.zeros((rowCount + 4,) + image.shape[1:], dtype=kernel.dtype)
+    padded[2:rowCount + 2] = image
 
-    (rowCount, colCount) = convolvedImage.shape
+    result = kernel[0] * padded[0:2 * keptCount:2]
+    for tap in range(1, 5):
+        result += kernel[tap] * padded[tap:tap + 2 * keptCount:2]
 
-    desiredR = np.arange(0, rowCount, 2)
-    desiredC = np.arange(0, colCount, 2)
+    return result
 
-    subsampledImage = convolvedImage[desiredR, :]
-    subsampledImage = subsampledImage[:, desiredC]
-    return subsampledImage
 
+def _expand_rows(image, kernel):
+    """ Zero-insert along the first axis and filter with zero padding.
 
-def expand(image):
-    """ Expand the image to double the size and then convolve it with a generating
-    kernel with a parameter of 0.4.
+    The inserted zeros are never multiplied: even output rows only see taps
+    0, 2 and 4 of the kernel and odd output rows only see taps 1 and 3.
+    """
+    rowCount = image.shape[0]
+
+    padded = np.zeros((rowCount + 2,) + image.shape[1:], dtype=kernel.dtype)
+    padded[1:rowCount + 1] = image
+
+    result = np.empty((2 * rowCount,) + image.shape[1:], dtype=kernel.dtype)
+    result[0::2] = kernel[0] * padded[:-2] + kernel[2] * padded[1:-1] + kernel[4] * padded[2:]
+    result[1::2] = kernel[1] * padded[1:-1] + kernel[3] * padded[2:]
+
+    return result
+
+
+def _zero_insert(image, axis):
+    """ Insert a zero after every sample along 'axis'. """
+    shape = list(image.shape)
+    shape[axis] *= 2
+    upSampledImage = np.zeros(shape, dtype=image.dtype)
+
+    index = [slice(None)] * image.ndim
+    index[axis] = slice(None, None, 2)
+    upSampledImage[tuple(index)] = image
+
+    return upSampledImage
 
-    You should upsample the image, and then convolve it with a generating kernel
-    of a = 0.4.
 
-    Finally, multiply your output image by a factor of 4 in order to scale it
-    back up. If you do not do this (and I recommend you try it out without that)
-    you will see that your images darken as you apply the convolution. Please
-    explain why this happens in your submission PDF.
+def _reduce_numpy(image, kernel):
+    rows = _reduce_rows(image, kernel)
+    return np.swapaxes(_reduce_rows(np.swapaxes(rows, 0, 1), kernel), 0, 1)
 
-    Please consult the lectures and readme for a more in-depth discussion of how
-    to tackle the expand function.
 
-    You can use any / all functions to convolve and reduce the image, although
-    the lectures have recommended methods that we advise since there are a lot
-    of pieces to this assignment that need to work 'just right'.
+def _expand_numpy(image, kernel):
+    rows = _expand_rows(image, kernel)
+    return np.swapaxes(_expand_rows(np.swapaxes(rows, 0, 1), kernel), 0, 1)
+
+
+def _reduce_scipy(image, kernel):
+    # Filter the columns of the kept rows only.
+    rows = scipy.ndimage.correlate1d(image, kernel, axis=0, mode='constant')[::2]
+    return scipy.ndimage.correlate1d(rows, kernel, axis=1, mode='constant')[:, ::2]
+
+
+def _expand_scipy(image, kernel):
+    rows = scipy.ndimage.correlate1d(_zero_insert(image, 0), kernel, axis=0, mode='constant')
+    return scipy.ndimage.correlate1d(_zero_insert(rows, 1), kernel, axis=1, mode='constant')
+
+
+def _reduce_cv2(image, kernel):
+    convolvedImage = cv2.sepFilter2D(np.ascontiguousarray(image), -1, kernel, kernel,
+                                     borderType=cv2.BORDER_CONSTANT)
+    return convolvedImage[::2, ::2]
+
+
+def _expand_cv2(image, kernel):
+    upSampledImage = _zero_insert(_zero_insert(image, 0), 1)
+    return cv2.sepFilter2D(upSampledImage, -1, kernel, kernel,
+                           borderType=cv2.BORDER_CONSTANT)
+
+
+_REDUCE_FUNCTIONS = {
+    'numpy': _reduce_numpy,
+    'scipy': _reduce_scipy,
+    'cv2': _reduce_cv2,
+}
+
+_EXPAND_FUNCTIONS = {
+    'numpy': _expand_numpy,
+    'scipy': _expand_scipy,
+    'cv2': _expand_cv2,
+}
+
+
+def reduce(image, backend=None):
+    """ Convolve the input image with a generating kernel of parameter of 0.4 and
+    then reduce its width and height by two.
+
+    The 5x5 kernel is separable, so this runs two 1-D passes with
+    generatingKernel1D(0.4). The result matches convolving with
+    generatingKernel(0.4) using zero padding ('same' mode) and keeping every
+    other row and column, up to floating point rounding (~1e-12 relative).
 
     Args:
-    image (numpy.ndarray): a grayscale image of shape (r, c)
+    image (numpy.ndarray): an image of shape (r, c) or (r, c, channels)
+    backend (str): one of CONVOLUTION_BACKENDS, defaults to CONVOLUTION_BACKEND.
 
     Returns:
-    output (numpy.ndarray): an image of shape (2*r, 2*c)
+    output (numpy.ndarray): an image of shape (ceil(r/2), ceil(c/2)[, channels])
+      For instance, if the input is 5x7, the output will be 3x4.
+
     """
+    dtype = _working_dtype(image)
+    kernel = generatingKernel1D(0.4).astype(dtype)
+
+    return _REDUCE_FUNCTIONS[backend or CONVOLUTION_BACKEND](image.astype(dtype, copy=False), kernel)
+
+
+def expand(image, backend=None):
+    """ Expand the image to double the size and then convolve it with a generating
+    kernel with a parameter of 0.4.
 
-    (rowCount, colCount) = image.shape
-    upSampledImage = np.ndarray(shape=(rowCount * 2, colCount * 2), dtype=image.dtype)
+    The image is upsampled by zero insertion and convolved with the separable
+    generatingKernel(0.4). The output is multiplied by 4 (2 per 1-D pass) to
+    make up for the inserted zeros, otherwise the image darkens.
 
-    for r in np.arange(2*rowCount):
-        for c in np.arange(2*colCount):
-            if r % 2 == 1 or c % 2 == 1:
-                upSampledImage[r][c] = 0
-            else:
-                upSampledImage[r, c] = image[r/2, c/2]
+    Args:
+    image (numpy.ndarray): an image of shape (r, c) or (r, c, channels)
+    backend (str): one of CONVOLUTION_BACKENDS, defaults to CONVOLUTION_BACKEND.
 
-    kernel = generatingKernel(0.4)
-    resultImage = sp.signal.convolve2d(upSampledImage, kernel, 'same')
-    resultImage = 4 * resultImage
+    Returns:
+    output (numpy.ndarray): an image of shape (2*r, 2*c[, channels])
+    """
+    dtype = _working_dtype(image)
+    kernel = (2 * generatingKernel1D(0.4)).astype(dtype)
 
-    return resultImage
+    return _EXPAND_FUNCTIONS[backend or CONVOLUTION_BACKEND](image.astype(dtype, copy=False), kernel)
 
 
-def gaussPyramid(image, levels):
+def gaussPyramid(image, levels, level_done=None):
   """ Construct a pyramid from the image by reducing it by the number of levels
   passed in by the input.
 
@@ -109,7 +216,8 @@ def gaussPyramid(image, levels):
   output.
 
   Args:
-    image (numpy.ndarray): A grayscale image of dimension (r,c) and dtype float.
+    image (numpy.ndarray): An image of dimension (r,c) or (r,c,channels) and
+                           dtype float. All channels are reduced together.
     levels (uint8): A positive integer that specifies the number of reductions
                     you should do. So, if levels = 0, you should return a list
                     containing just the input image. If levels = 1, you should
@@ -124,16 +232,133 @@ def gaussPyramid(image, levels):
                    numpy.ndarray.
 
   Consult the lecture and README for more details about Gaussian Pyramids.
+
+  'level_done', if given, is called without arguments after each reduction.
   """
   output = [image]
 
   for level in np.arange(levels):
-      output.append(reduce(output[level]))
+      with Profiler.stage('reduce', level=int(level) + 1):
+          output.append(reduce(output[level]))
+      if level_done is not None:
+          level_done()
+
+  return output
+
+
+def gaussPyramid1D(vector, levels):
+  """ Construct the Gaussian pyramid of a 1-D signal with the 1-D factor of the
+  generating kernel.
+
+  The reduce() of a separable image np.outer(a, b) is np.outer of the reduced
+  a and b, so this gives the pyramids of separable images at 1-D cost.
+
+  Returns:
+    output (list): len(output) = levels + 1, output[0] is the vector itself.
+  """
+  kernel = generatingKernel1D(0.4).astype(_working_dtype(vector))
+  output = [vector]
+
+  for level in np.arange(levels):
+      output.append(_reduce_rows(output[level][:, np.newaxis], kernel)[:, 0])
+
+  return output
+
+
+def maskPyramid(mask, levels):
+  """ Construct a Gaussian pyramid of a (r, c) mask, corrected for the image
+  border.
+
+  reduce() pads with zeros, so on its own a mask of all ones drops below 1 near
+  the border at every level and the black image bleeds into the frame edges.
+  Each level is divided by the same pyramid of an all ones image, which is
+  separable and computed from two 1-D pyramids.
+
+  Args:
+    mask (numpy.ndarray): A (r, c) float mask with values in [0, 1].
+    levels (int): Number of reductions, as in gaussPyramid.
+
+  Returns:
+    output (list): len(output) = levels + 1, values in [0, 1].
+  """
+  output = gaussPyramid(mask, levels)
+
+  dtype = _working_dtype(mask)
+  rowWeights = gaussPyramid1D(np.ones(mask.shape[0], dtype=dtype), levels)
+  colWeights = gaussPyramid1D(np.ones(mask.shape[1], dtype=dtype), levels)
+
+  for level in np.arange(1, levels + 1):
+      output[level] = output[level] / np.outer(rowWeights[level], colWeights[level])
+
+  return output
+
+
+# Fixed point scale of int16 Laplacian levels: 7 fractional bits leave room for +-255
+FIXED_POINT_SCALE = 2 ** 7
+
+
+def to_fixed_point(image):
+  """ Return a float image with values within +-255 as int16 fixed point,
+  scaled by FIXED_POINT_SCALE. """
+  return np.clip(np.rint(image * FIXED_POINT_SCALE), -32768, 32767).astype(np.int16)
+
+
+def fixedPointLaplPyramid(image, levels, level_done=None):
+  """ Construct the Laplacian pyramid of a float image with values in [0, 255],
+  stored in int16 fixed point (see to_fixed_point()).
+
+  Each level is quantized as soon as it is computed, so only two Gaussian
+  levels are kept in floating point at a time. Laplacian levels of such an
+  image stay within +-255, since the generating kernel is non negative and
+  sums to 1.
+
+  'level_done', if given, is called after each reduction and each Laplacian
+  level, as gaussPyramid() and laplPyramid() would.
+
+  Returns:
+    output (list): len(output) = levels + 1 int16 arrays, like laplPyramid().
+  """
+  output = []
+  gaussLevel = image
+
+  for level in np.arange(levels):
+      with Profiler.stage('reduce', level=int(level) + 1):
+          nextGaussLevel = reduce(gaussLevel)
+      if level_done is not None:
+          level_done()
+
+      (gaussLayerR, gaussLayerC) = gaussLevel.shape[:2]
+      with Profiler.stage('expand', level=int(level)):
+          expandResult = expand(nextGaussLevel)[:gaussLayerR, :gaussLayerC]
+          output.append(to_fixed_point(gaussLevel - expandResult))
+      if level_done is not None:
+          level_done()
+
+      gaussLevel = nextGaussLevel
+
+  output.append(to_fixed_point(gaussLevel))
 
   return output
 
 
-def laplPyramid(gaussPyr):
+def pyramid_depth(shape):
+  """ Return the pyramid depth run_blend() uses for images of 'shape'. """
+  min_size = min(shape[:2])
+  return int(math.floor(math.log(min_size, 2))) - 4 # at least 16x16 at the highest level.
+
+
+def pyramid_support_radius(depth):
+  """ Return how far, in pixels, a mask or image pixel can influence the output
+  of run_blend() with pyramid depth 'depth'.
+
+  Every reduce() reaches 2 samples out at its level (2**level pixels for the
+  reduction to 'level'), and every expand() in collapse() reaches 1 sample out at
+  its input level. Summed over all levels this stays below 2**(depth + 2).
+  """
+  return 2 ** (max(depth, 0) + 2)
+
+
+def laplPyramid(gaussPyr, level_done=None):
     """ Construct a Laplacian pyramid from the Gaussian pyramid, of height levels.
 
     Note: You must use your expand function in this function to generate the
@@ -162,19 +387,23 @@ def laplPyramid(gaussPyr):
 
     For example, if my layer is of size 5x7, reducing and expanding will result
     in an image of size 6x8. In this case, crop the expanded layer to 5x7.
+
+    'level_done', if given, is called without arguments after each level.
     """
     output = []
 
     for i in np.arange(len(gaussPyr) - 1):
-        (gaussLayerR, gaussLayerC) = gaussPyr[i].shape
+        (gaussLayerR, gaussLayerC) = gaussPyr[i].shape[:2]
 
-        expandResult = expand(gaussPyr[i + 1])
-        expandResult = expandResult[np.arange(gaussLayerR), :]
-        expandResult = expandResult[:, np.arange(gaussLayerC)]
+        with Profiler.stage('expand', level=int(i)):
+            expandResult = expand(gaussPyr[i + 1])
+            expandResult = expandResult[:gaussLayerR, :gaussLayerC]
 
-        newLayer = gaussPyr[i] - expandResult
+            newLayer = gaussPyr[i] - expandResult
 
         output.append(newLayer)
+        if level_done is not None:
+            level_done()
 
     output.append(gaussPyr[len(gaussPyr)-1])
 
@@ -193,7 +422,9 @@ def blend(laplPyrWhite, laplPyrBlack, gaussPyrMask):
                              your laplPyramid function.
 
         gaussPyrMask (list): A Gaussian pyramid of the mask. Each value is in the
-                             range of [0, 1].
+                             range of [0, 1]. A single channel (r, c) mask is
+                             broadcast over every channel of (r, c, channels)
+                             images, so it only needs to be built once.
 
     The pyramids will have the same number of levels. Furthermore, each layer
     is guaranteed to have the same shape as previous levels.
@@ -225,19 +456,18 @@ def blend(laplPyrWhite, laplPyrBlack, gaussPyrMask):
         blackImg = laplPyrBlack[i]
         mask = gaussPyrMask[i]
 
-        (rowCount, colCount) = mask.shape
-        result = np.ndarray(shape=(rowCount, colCount), dtype=np.float)
+        if mask.ndim < whiteImg.ndim:
+            mask = mask[..., np.newaxis]
 
-        for i in np.arange(rowCount):
-            for j in np.arange(colCount):
-                result[i, j] = mask[i, j] * whiteImg[i, j] + (1 - mask[i, j]) * blackImg[i, j]
+        with Profiler.stage('blend', level=int(i)):
+            result = mask * whiteImg + (1 - mask) * blackImg
 
         blended_pyr.append(result)
 
     return blended_pyr
 
 
-def collapse(pyramid):
+def collapse(pyramid, level_done=None):
     """ Collapse an input pyramid.
 
     Args:
@@ -259,118 +489,435 @@ def collapse(pyramid):
 
     For example, expanding a layer of size 3x4 will result in an image of size
     6x8. If the next layer is of size 5x7, crop the expanded image to size 5x7.
+
+    'level_done', if given, is called without arguments after each level.
     """
 
-    (rowCount, colCount) = pyramid[0].shape
-    result = np.ndarray(shape=(rowCount, colCount), dtype=np.float)
     layerCount = len(pyramid)
 
     # start at the last layer
     onGoingSum = pyramid[layerCount - 1]
     for layer in np.arange(layerCount-2, -1, -1):
-        expandResult = expand(onGoingSum)
-        currLayer = pyramid[layer]
+        with Profiler.stage('collapse', level=int(layer)):
+            expandResult = expand(onGoingSum)
+            currLayer = pyramid[layer]
 
-        # Crop layer to match next layer
-        (rowCount, colCount) = currLayer.shape
-        expandResult = expandResult[np.arange(rowCount), :]
-        expandResult = expandResult[:, np.arange(colCount)]
+            # Crop layer to match next layer
+            (rowCount, colCount) = currLayer.shape[:2]
+            expandResult = expandResult[:rowCount, :colCount]
 
-        onGoingSum = expandResult + currLayer
+            onGoingSum = expandResult + currLayer
+        if level_done is not None:
+            level_done()
 
     return onGoingSum
 
-def run_blend(black_image, white_image, mask):
+def run_blend(black_image, white_image, mask, depth=None, gauss_pyr_mask=None,
+              progress_callback=None, lapl_pyr_black=None, lapl_pyr_white=None,
+              fixed_point=False):
   """ This function administrates the blending of the two images according to
   mask.
 
-  Assume all images are float dtype, and return a float dtype.
-  """
+  Assume all images are float dtype, and return a float dtype. The images may
+  have several channels (r, c, channels), in which case they are blended in one
+  pass with the single channel (r, c) mask.
 
-  # Automatically figure out the size
-  min_size = min(black_image.shape)
-  depth = int(math.floor(math.log(min_size, 2))) - 4 # at least 16x16 at the highest level.
+  'depth' defaults to pyramid_depth(black_image.shape). Pass it explicitly when
+  blending a crop that has to match the blend of the full image.
+
+  'gauss_pyr_mask' is a precomputed maskPyramid() of depth 'depth', e.g. from
+  ImageMask.gauss_pyramid(). 'mask' is not used when it is given.
 
-  gauss_pyr_mask = gaussPyramid(mask, depth)
-  gauss_pyr_black = gaussPyramid(black_image, depth)
-  gauss_pyr_white = gaussPyramid(white_image, depth)
+  'progress_callback(done, total)', if given, is called after every pyramid
+  level of every step. It may raise to abort the blend.
 
+  'lapl_pyr_black' and 'lapl_pyr_white' are precomputed laplPyramid()s of depth
+  'depth' of the images, e.g. from an earlier blend of the same image. The image
+  is not used when its pyramid is given, and its Gaussian pyramid is returned
+  as None.
 
-  lapl_pyr_black  = laplPyramid(gauss_pyr_black)
-  lapl_pyr_white = laplPyramid(gauss_pyr_white)
+  With 'fixed_point', the Laplacian pyramids are fixedPointLaplPyramid()s
+  (given ones too) and both Gaussian pyramids are returned as None. Blend and
+  collapse are linear, so they run on the scaled values, and only the output
+  is divided by FIXED_POINT_SCALE.
+  """
+
+  # Automatically figure out the size
+  if depth is None:
+      depth = pyramid_depth(black_image.shape)
+
+  # Two Gaussian and two Laplacian pyramids (unless given), the blend and the collapse
+  pyramids_to_build = int(lapl_pyr_black is None) + int(lapl_pyr_white is None)
+  progress = {'done': 0, 'total': (2 * pyramids_to_build + 1) * max(depth, 0) + 1}
+
+  def level_done():
+      progress['done'] += 1
+      if progress_callback is not None:
+          progress_callback(progress['done'], progress['total'])
+
+  if gauss_pyr_mask is None:
+      with Profiler.stage('mask'):
+          gauss_pyr_mask = maskPyramid(mask, depth)
+
+  gauss_pyr_black = None
+  if lapl_pyr_black is None and fixed_point:
+      lapl_pyr_black = fixedPointLaplPyramid(black_image, depth, level_done)
+  elif lapl_pyr_black is None:
+      gauss_pyr_black = gaussPyramid(black_image, depth, level_done)
+      lapl_pyr_black = laplPyramid(gauss_pyr_black, level_done)
+
+  gauss_pyr_white = None
+  if lapl_pyr_white is None and fixed_point:
+      lapl_pyr_white = fixedPointLaplPyramid(white_image, depth, level_done)
+  elif lapl_pyr_white is None:
+      gauss_pyr_white = gaussPyramid(white_image, depth, level_done)
+      lapl_pyr_white = laplPyramid(gauss_pyr_white, level_done)
 
   outpyr = blend(lapl_pyr_white, lapl_pyr_black, gauss_pyr_mask)
-  outimg = collapse(outpyr)
+  level_done()
+  outimg = collapse(outpyr, level_done)
+  if fixed_point:
+      outimg = outimg / FIXED_POINT_SCALE
 
-  outimg[outimg < 0] = 0 # blending sometimes results in slightly out of bound numbers.
-  outimg[outimg > 255] = 255
-  outimg = outimg.astype(np.uint8)
+  # Blending sometimes results in slightly out of bound numbers. Round rather than
+  # truncate, so samples that reconstruct to just below an integer are not lost.
+  outimg = np.clip(np.rint(outimg), 0, 255).astype(np.uint8)
 
   return lapl_pyr_black, lapl_pyr_white, gauss_pyr_black, gauss_pyr_white, \
       gauss_pyr_mask, outpyr, outimg
 
 
+# Sample types of the blending pipeline, see ImageBlender:
+#   float64 - reference precision
+#   float32 - images, pyramids and mask in float32
+#   int16   - Laplacian levels stored in int16 fixed point, blended and collapsed in float32
+PRECISIONS = ('float64', 'float32', 'int16')
+DEFAULT_PRECISION = 'float32'
+
+# Default memory budget of the Laplacian pyramid cache. The cache only pays off when the same
+# image pair is blended again, e.g. in the GUI, and otherwise only holds memory, so it is off.
+DEFAULT_PYRAMID_CACHE_MAX_BYTES = 0
+
+# Default size of the square tiles of ImageBlender.blend_tiled(), in pixels
+DEFAULT_TILE_SIZE = 4096
+
+
+def create_image_memmap(filename, shape, dtype=np.uint8):
+    """
+    Create a .npy file for an image of 'shape' and return it as a writable np.memmap.
+    """
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+
+
+def open_image_memmap(filename, mode='r'):
+    """
+    Return the image in a .npy file as a np.memmap, so it is read from disk as it is sliced.
+    """
+    return np.load(filename, mmap_mode=mode)
+
+
 class ImageBlender:
     """
     Handles creating masks and performing image blending.
+
+    With a pyramid_cache_max_bytes budget, the Laplacian pyramids of blended
+    images are kept in an LRU cache keyed by image contents and pyramid depth, so
+    blending the same image pair again with another mask only builds the mask
+    pyramid, blends and collapses.
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, pyramid_cache_max_bytes=DEFAULT_PYRAMID_CACHE_MAX_BYTES, precision=DEFAULT_PRECISION):
+        """
+        :param pyramid_cache_max_bytes: memory budget of the pyramid cache, 0 disables it
+        :param precision: sample type of the pyramids, one of PRECISIONS. int16 halves the memory of
+            the Laplacian pyramids against float32, PrecisionBenchmark.py measures the error.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision '%s', expected one of %s" % (precision, ', '.join(PRECISIONS)))
 
-    def blend(self, white_image, black_image, mask):
+        self.precision = precision
+        self.pyramid_cache = None
+        if pyramid_cache_max_bytes > 0:
+            self.pyramid_cache = LruCache(max_bytes=pyramid_cache_max_bytes)
+
+    def blend(self, white_image, black_image, mask, depth=None, progress_callback=None, cache_pyramids=True):
         """
         Blend white and black images using provided mask.
+        'mask' is either an image (0 selects the black image, 255 the white one) or
+        an ImageMask shape description, whose pyramid is built from its shapes.
+        'depth' overrides the pyramid depth picked from the image size.
+        'progress_callback(done, total)' is called per pyramid level, see run_blend().
+        'cache_pyramids' set to False skips the pyramid cache, for images that will not be blended again.
         """
         if white_image is None or black_image is None or mask is None:
             print "[ERROR] ImageBlender::blend() - Black/white/mask images are None"
             return None
 
-        if black_image.shape != white_image.shape or black_image.shape != mask.shape:
+        if black_image.shape != white_image.shape or black_image.shape[:2] != mask.shape[:2]:
             print "[ERROR] ImageBlender::blend() - The sizes of images and the mask are not equal"
             return None
 
-        black_img = black_image.astype(float)
-        white_img = white_image.astype(float)
-        mask_img = mask.astype(float) / 255
+        if depth is None:
+            depth = pyramid_depth(black_image.shape)
+
+        # int16 pyramids are blended and collapsed in float32
+        dtype = np.float64 if self.precision == 'float64' else np.float32
+        mask_img = None
+        gauss_pyr_mask = None
+
+        if isinstance(mask, np.ndarray):
+            # All channels share the mask, so only its first channel is needed.
+            if mask.ndim == 3:
+                mask = mask[:, :, 0]
+            mask_img = mask.astype(dtype) / 255
+        else:
+            with Profiler.stage('mask'):
+                gauss_pyr_mask = mask.gauss_pyramid(depth, dtype)
+
+        black_key = None
+        white_key = None
+        if cache_pyramids:
+            black_key = self.__pyramid_key(black_image, depth)
+            white_key = self.__pyramid_key(white_image, depth)
+        cached_lapl_pyr_black = self.__get_cached_pyramid(black_key)
+        cached_lapl_pyr_white = self.__get_cached_pyramid(white_key)
+
+        black_img = None
+        if cached_lapl_pyr_black is None:
+            black_img = black_image.astype(dtype)
+        white_img = None
+        if cached_lapl_pyr_white is None:
+            white_img = white_image.astype(dtype)
+
+        lapl_pyr_black, lapl_pyr_white, gauss_pyr_black, gauss_pyr_white, gauss_pyr_mask,\
+            outpyr, outimg = run_blend(black_img, white_img, mask_img, depth, gauss_pyr_mask, progress_callback,
+                                       cached_lapl_pyr_black, cached_lapl_pyr_white, self.precision == 'int16')
+
+        if black_key is not None:
+            self.pyramid_cache.put(black_key, lapl_pyr_black)
+            self.pyramid_cache.put(white_key, lapl_pyr_white)
+
+        return outimg
+
+
+    def __blend_region(self, white_image, black_image, mask, depth, region, progress_callback=None,
+                       cache_pyramids=True):
+        """
+        Return the pixels of region (top, left, bottom, right) of blend() with pyramid depth 'depth',
+        blending only a window around it.
+
+        The window is padded by the pyramid support radius, so its borders do not reach the region,
+        and its origin is on the coarsest level's sampling grid, so every level samples the same
+        pixels as the full image pyramid.
+        """
+        (top, left, bottom, right) = region
+        (rowCount, colCount) = white_image.shape[:2]
+        radius = pyramid_support_radius(depth)
+        step = 2 ** max(depth, 0)
+
+        window_top = max(top - radius, 0) // step * step
+        window_left = max(left - radius, 0) // step * step
+        window_bottom = min(bottom + radius, rowCount)
+        window_right = min(right + radius, colCount)
+        window = (slice(window_top, window_bottom), slice(window_left, window_right))
+        inside = (slice(top - window_top, bottom - window_top), slice(left - window_left, right - window_left))
+
+        if isinstance(mask, np.ndarray):
+            window_mask = np.asarray(mask[window])
+            if window_mask.ndim == 3:
+                window_mask = window_mask[:, :, 0]
+            all_white = not (window_mask < 255).any()
+        else:
+            window_mask = mask.crop(window_top, window_left, window_bottom, window_right)
+            all_white = window_mask.bounding_box() is None
+
+        # The mask does not reach the region, so blend() would return the white image there
+        if all_white:
+            return np.asarray(white_image[top:bottom, left:right])
+
+        window_result = self.blend(np.asarray(white_image[window]), np.asarray(black_image[window]), window_mask,
+                                   depth, progress_callback, cache_pyramids)
+        return window_result[inside]
+
+
+    def get_pyramid_cache_statistics(self):
+        """
+        Return the LruCache statistics of the pyramid cache, or None if it is disabled.
+        """
+        if self.pyramid_cache is None:
+            return None
+        return self.pyramid_cache.get_statistics()
+
 
-        out_layers = []
+    def __pyramid_key(self, image, depth):
+        if self.pyramid_cache is None:
+            return None
+        return (image_digest(image), depth, CONVOLUTION_BACKEND, self.precision)
 
-        for channel in range(3):
-            lapl_pyr_black, lapl_pyr_white, gauss_pyr_black, gauss_pyr_white, gauss_pyr_mask,\
-                outpyr, outimg = run_blend(black_img[:,:,channel], white_img[:,:,channel], mask_img[:,:,channel])
 
-            out_layers.append(outimg)
+    def __get_cached_pyramid(self, key):
+        if key is None:
+            return None
+        return self.pyramid_cache.get(key)
 
-        outimg = cv2.merge(out_layers)
 
-        return outimg
+    def blend_roi(self, white_image, black_image, mask, progress_callback=None):
+        """
+        Same result as blend(), but only the region around the black part of the
+        mask is recomputed.
+
+        Pixels further than the pyramid support radius from any mask pixel below
+        255 come out of blend() equal to the white image, so they are copied
+        from it. The rest is blended in a window around it, see __blend_region().
+        The pyramid depth of the full image is kept.
+
+        'mask' is an image or an ImageMask, as for blend().
+        """
+        if white_image is None or black_image is None or mask is None:
+            print "[ERROR] ImageBlender::blend_roi() - Black/white/mask images are None"
+            return None
+
+        if black_image.shape != white_image.shape or black_image.shape[:2] != mask.shape[:2]:
+            print "[ERROR] ImageBlender::blend_roi() - The sizes of images and the mask are not equal"
+            return None
+
+        if isinstance(mask, np.ndarray):
+            if mask.ndim == 3:
+                mask = mask[:, :, 0]
+
+            (rows, cols) = np.nonzero(mask < 255)
+            bounding_box = None
+            if len(rows) > 0:
+                bounding_box = (rows.min(), cols.min(), rows.max() + 1, cols.max() + 1)
+        else:
+            bounding_box = mask.bounding_box()
+
+        if bounding_box is None:
+            return white_image.copy()
+
+        (rowCount, colCount) = mask.shape[:2]
+        depth = pyramid_depth(mask.shape)
+        radius = pyramid_support_radius(depth)
+
+        # Region whose output can differ from the white image
+        (top, left, bottom, right) = bounding_box
+        inner_top = max(top - radius, 0)
+        inner_left = max(left - radius, 0)
+        inner_bottom = min(bottom + radius, rowCount)
+        inner_right = min(right + radius, colCount)
+
+        result = white_image.copy()
+        result[inner_top:inner_bottom, inner_left:inner_right] = self.__blend_region(
+            white_image, black_image, mask, depth, (inner_top, inner_left, inner_bottom, inner_right),
+            progress_callback)
+
+        return result
+
+
+    def blend_tiled(self, white_image, black_image, mask, output_image=None, tile_size=DEFAULT_TILE_SIZE,
+                    depth=None, progress_callback=None):
+        """
+        Same result as blend(), computed tile by tile so only one tile's pyramids are in memory.
+
+        Each tile is blended from a window padded by the pyramid support radius and aligned to
+        the coarsest pyramid level, as in blend_roi(), so tiles meet without seams. Windows
+        without any BLACK mask pixel are copied from the white image.
+
+        The images and the output are only sliced, so they can be np.memmap arrays, e.g. from
+        open_image_memmap() and create_image_memmap(), larger than memory. The windows are
+        (tile_size + 2 * pyramid_support_radius(depth)) pixels wide: with deep pyramids, larger
+        tiles waste less time on the halos but need more memory.
+
+        'mask' is an image (may be a np.memmap as well) or an ImageMask, as for blend().
+        'output_image' defaults to a new uint8 array. It is returned, and flushed if it is a np.memmap.
+        'depth' defaults to the depth blend() picks for the whole image.
+        'progress_callback(done, total)' is called after every tile.
+        """
+        if white_image is None or black_image is None or mask is None:
+            print "[ERROR] ImageBlender::blend_tiled() - Black/white/mask images are None"
+            return None
+
+        if black_image.shape != white_image.shape or black_image.shape[:2] != mask.shape[:2]:
+            print "[ERROR] ImageBlender::blend_tiled() - The sizes of images and the mask are not equal"
+            return None
+
+        if output_image is None:
+            output_image = np.empty(white_image.shape, dtype=np.uint8)
+
+        if depth is None:
+            depth = pyramid_depth(white_image.shape)
+
+        (rowCount, colCount) = white_image.shape[:2]
+        tiles = [(top, left) for top in range(0, rowCount, tile_size) for left in range(0, colCount, tile_size)]
+
+        for index, (top, left) in enumerate(tiles):
+            region = (top, left, min(top + tile_size, rowCount), min(left + tile_size, colCount))
+            with Profiler.stage('tile', top=top, left=left):
+                output_image[region[0]:region[2], region[1]:region[3]] = self.__blend_region(
+                    white_image, black_image, mask, depth, region, cache_pyramids=False)
+
+            if progress_callback is not None:
+                progress_callback(index + 1, len(tiles))
+
+        if isinstance(output_image, np.memmap):
+            output_image.flush()
+
+        return output_image
+
+
+    def blend_preview(self, white_image, black_image, mask, scale, progress_callback=None, white_preview=None):
+        """
+        Blend downscaled copies of the images and return the result at 'scale' of
+        the input size. It runs the same pyramid blend as blend(), so it is a
+        preview of the full resolution result.
+
+        'white_preview' is an already downscaled white image, e.g. decoded at reduced
+        resolution, used instead of downscaling 'white_image'.
+
+        With a power of two 'scale' the preview pyramid has as many fewer levels
+        as the images are halved, so its coarsest level, which sets how wide the
+        seam blends, covers the same area as in the full resolution pyramid.
+        """
+        if white_image is None or black_image is None or mask is None:
+            print "[ERROR] ImageBlender::blend_preview() - Black/white/mask images are None"
+            return None
+
+        if scale >= 1:
+            return self.blend(white_image, black_image, mask, progress_callback=progress_callback)
+
+        size = (int(round(white_image.shape[1] * scale)), int(round(white_image.shape[0] * scale)))
+        if white_preview is None:
+            white_preview = cv2.resize(white_image, size, interpolation=cv2.INTER_AREA)
+        elif (white_preview.shape[1], white_preview.shape[0]) != size:
+            # Reduced decodes round odd sizes up
+            white_preview = cv2.resize(white_preview, size, interpolation=cv2.INTER_AREA)
+        black_preview = cv2.resize(black_image, size, interpolation=cv2.INTER_AREA)
+
+        if isinstance(mask, np.ndarray):
+            mask_preview = cv2.resize(mask, size, interpolation=cv2.INTER_AREA)
+        else:
+            mask_preview = mask.scale(scale)
+
+        return self.blend(white_preview, black_preview, mask_preview, progress_callback=progress_callback)
 
 
     def create_rectangular_mask(self, mask_size, mask_coordinates):
         """
-        Return a WHITE image of size 'mask_size' and
-        a BLACK region located at 'mask_coordinates'.
+        Return a single channel uint8 WHITE image of size 'mask_size' and
+        a BLACK region located at 'mask_coordinates' (edges included).
 
-        'mask_size' is a tuple (width, height)
+        'mask_size' is a tuple (height, width)
         'mask_coordinates' is a tuple (x, y, width, height).
+
+        See ImageMask for several rectangles, polygons and masks whose pyramid
+        is built without rendering them first.
         """
 
         (rowCount, colCount) = mask_size
         (x, y, width, height) = mask_coordinates
 
-        mask_image = np.ndarray(shape=(rowCount, colCount, 3), dtype=np.float)
-
-        for row in np.arange(rowCount):
-            for col in np.arange(colCount):
-                if row >= y and row <= y + height and col >= x and col <= x + width:
-                    mask_image[row, col, 0] = 0
-                    mask_image[row, col, 1] = 0
-                    mask_image[row, col, 2] = 0
-                else:
-                    mask_image[row, col, 0] = 255
-                    mask_image[row, col, 1] = 255
-                    mask_image[row, col, 2] = 255
+        mask_image = np.full((rowCount, colCount), 255, dtype=np.uint8)
+        mask_image[max(y, 0):max(y + height + 1, 0), max(x, 0):max(x + width + 1, 0)] = 0
 
         return mask_image
 
@@ -0,0 +1,162 @@
+import cv2
+import numpy as np
+from ImageBlender import gaussPyramid1D, maskPyramid
+
+
+class ImageMask:
+    """
+    Shape description of a blending mask: WHITE (take the white image) everywhere except
+    inside a set of rectangles and polygons, which are BLACK (take the black image).
+
+    The mask is only rendered when needed, as a single channel uint8 or float32 image.
+    For disjoint rectangles its Gaussian pyramid is computed analytically: a rectangle is the
+    outer product of a row and a column indicator, so each level only needs two 1-D pyramids.
+    """
+
+    def __init__(self, mask_size):
+        """
+        :param mask_size: tuple (height, width)
+        """
+        self.shape = tuple(mask_size[:2])
+        self.rectangles = []
+        self.polygons = []
+
+
+    def add_rectangle(self, x, y, width, height):
+        """
+        Add a BLACK rectangle. Like ImageBlender.create_rectangular_mask(), its right and bottom
+        edges (x + width, y + height) are included. Returns self.
+        """
+        top = min(max(y, 0), self.shape[0])
+        left = min(max(x, 0), self.shape[1])
+        bottom = min(max(y + height + 1, 0), self.shape[0])
+        right = min(max(x + width + 1, 0), self.shape[1])
+
+        if bottom > top and right > left:
+            self.rectangles.append((top, left, bottom, right))
+
+        return self
+
+
+    def add_polygon(self, points):
+        """
+        Add a BLACK polygon given by its (x, y) vertices. Returns self.
+        """
+        self.polygons.append(np.array(points, dtype=np.int32).reshape(-1, 2))
+        return self
+
+
+    def bounding_box(self):
+        """
+        Return (top, left, bottom, right) around all BLACK pixels, bottom/right excluded,
+        or None if the mask is all WHITE.
+        """
+        boxes = list(self.rectangles)
+        for polygon in self.polygons:
+            boxes.append((max(polygon[:, 1].min(), 0), max(polygon[:, 0].min(), 0),
+                          min(polygon[:, 1].max() + 1, self.shape[0]), min(polygon[:, 0].max() + 1, self.shape[1])))
+
+        boxes = [box for box in boxes if box[2] > box[0] and box[3] > box[1]]
+        if len(boxes) == 0:
+            return None
+
+        return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+                max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+    def crop(self, top, left, bottom, right):
+        """
+        Return the ImageMask of the region [top:bottom, left:right].
+        """
+        cropped = ImageMask((bottom - top, right - left))
+        for (rect_top, rect_left, rect_bottom, rect_right) in self.rectangles:
+            cropped.add_rectangle(rect_left - left, rect_top - top,
+                                  rect_right - rect_left - 1, rect_bottom - rect_top - 1)
+        for polygon in self.polygons:
+            cropped.add_polygon(polygon - [left, top])
+        return cropped
+
+
+    def scale(self, factor):
+        """
+        Return this mask for the image resized by 'factor'. Rectangles grow outwards to whole pixels.
+        """
+        scaled = ImageMask((int(round(self.shape[0] * factor)), int(round(self.shape[1] * factor))))
+        for (top, left, bottom, right) in self.rectangles:
+            scaled_top = int(np.floor(top * factor))
+            scaled_left = int(np.floor(left * factor))
+            scaled.add_rectangle(scaled_left, scaled_top,
+                                 int(np.ceil(right * factor)) - scaled_left - 1,
+                                 int(np.ceil(bottom * factor)) - scaled_top - 1)
+        for polygon in self.polygons:
+            scaled.add_polygon(np.round(polygon * factor))
+        return scaled
+
+
+    def render(self, dtype=np.uint8):
+        """
+        Return the mask as a single channel image: 255 for WHITE and 0 for BLACK with dtype uint8,
+        or blending weights 1.0 and 0.0 with a float dtype.
+        """
+        white = 255 if np.dtype(dtype).kind in 'ui' else 1.0
+        mask_image = np.full(self.shape, white, dtype=dtype)
+
+        for (top, left, bottom, right) in self.rectangles:
+            mask_image[top:bottom, left:right] = 0
+
+        if len(self.polygons) > 0:
+            cv2.fillPoly(mask_image, list(self.polygons), 0)
+
+        return mask_image
+
+
+    def gauss_pyramid(self, levels, dtype=np.float32):
+        """
+        Return the Gaussian pyramid of the mask's blending weights, as ImageBlender.maskPyramid()
+        computes it from render(dtype), up to floating point rounding.
+        """
+        if len(self.polygons) > 0 or not self.__rectangles_are_disjoint():
+            return maskPyramid(self.render(dtype), levels)
+
+        (rowCount, colCount) = self.shape
+
+        # With W = 1 - sum(R_i) and G(R_i) = outer(g(rows_i), g(cols_i)), each level is
+        # G(W) / G(1) = 1 - sum(outer(g(rows_i) / g(1 rows), g(cols_i) / g(1 cols))).
+        row_ones = gaussPyramid1D(np.ones(rowCount, dtype=dtype), levels)
+        col_ones = gaussPyramid1D(np.ones(colCount, dtype=dtype), levels)
+
+        rectangle_pyramids = []
+        for (top, left, bottom, right) in self.rectangles:
+            rows = np.zeros(rowCount, dtype=dtype)
+            rows[top:bottom] = 1
+            cols = np.zeros(colCount, dtype=dtype)
+            cols[left:right] = 1
+            rectangle_pyramids.append((gaussPyramid1D(rows, levels), gaussPyramid1D(cols, levels)))
+
+        output = []
+        for level in range(levels + 1):
+            weights = np.ones((len(row_ones[level]), len(col_ones[level])), dtype=dtype)
+
+            for (row_pyramid, col_pyramid) in rectangle_pyramids:
+                # Only update the band where the rectangle has reached at this level
+                rows = np.nonzero(row_pyramid[level])[0]
+                cols = np.nonzero(col_pyramid[level])[0]
+                if len(rows) == 0 or len(cols) == 0:
+                    continue
+
+                row_band = slice(rows[0], rows[-1] + 1)
+                col_band = slice(cols[0], cols[-1] + 1)
+                weights[row_band, col_band] -= np.outer(row_pyramid[level][row_band] / row_ones[level][row_band],
+                                                        col_pyramid[level][col_band] / col_ones[level][col_band])
+
+            output.append(weights)
+
+        return output
+
+
+    def __rectangles_are_disjoint(self):
+        for index, (top, left, bottom, right) in enumerate(self.rectangles):
+            for (other_top, other_left, other_bottom, other_right) in self.rectangles[index + 1:]:
+                if top < other_bottom and other_top < bottom and left < other_right and other_left < right:
+                    return False
+        return True
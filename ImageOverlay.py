@@ -0,0 +1,62 @@
+import numpy as np
+
+
+def covered_pixels(aligned_image):
+    """
+    Return a boolean mask of the pixels an aligned secondary image covers.
+    Pixels outside the warped secondary image are black, so they are detected by a zero first channel.
+    """
+    return aligned_image[:, :, 0] > 0
+
+
+class ImageOverlay:
+    """
+    Builds composites of an aligned secondary image over the primary image with whole-array
+    boolean mask operations.
+
+    The output buffers are allocated once per image size and reused by every call, so the returned
+    images are overwritten by the next call. Copy them if they have to be kept.
+    """
+
+    def __init__(self):
+        self.highlight = None
+        self.highlight_merge = None
+        self.merge = None
+
+
+    def build_highlights(self, primary_image, aligned_image):
+        """
+        Return (highlight, highlight_merge):
+            highlight       - the primary image with its first channel zeroed where the secondary covers it
+            highlight_merge - the primary image with the covered area replaced by the secondary image,
+                              also with its first channel zeroed there
+        """
+        covered = covered_pixels(aligned_image)
+
+        self.highlight = self.__reuse_buffer(self.highlight, primary_image)
+        np.copyto(self.highlight, primary_image)
+        self.highlight[:, :, 0][covered] = 0
+
+        self.highlight_merge = self.__reuse_buffer(self.highlight_merge, primary_image)
+        np.copyto(self.highlight_merge, primary_image)
+        np.copyto(self.highlight_merge, aligned_image, where=covered[:, :, np.newaxis])
+        self.highlight_merge[:, :, 0][covered] = 0
+
+        return self.highlight, self.highlight_merge
+
+
+    def build_merge(self, primary_image, aligned_image):
+        """
+        Return the primary image with the area covered by the secondary image replaced by it.
+        """
+        self.merge = self.__reuse_buffer(self.merge, primary_image)
+        np.copyto(self.merge, primary_image)
+        np.copyto(self.merge, aligned_image, where=covered_pixels(aligned_image)[:, :, np.newaxis])
+
+        return self.merge
+
+
+    def __reuse_buffer(self, buffer, image):
+        if buffer is None or buffer.shape != image.shape or buffer.dtype != image.dtype:
+            return np.empty_like(image)
+        return buffer
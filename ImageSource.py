@@ -1,20 +1,94 @@
+from multiprocessing.pool import ThreadPool
+import multiprocessing
 import cv2
+import numpy as np
 import os
 import re
+import tempfile
+import threading
+import time
+from ImageBlender import create_image_memmap
+from LruCache import LruCache, nbytes_of
+import Profiler
+
+# Default limit for decoded secondary images kept in memory
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Default limit for aligned secondary images and their masks kept in memory. Past it they are
+# kept in np.memmap files, so aligning many frames (e.g. for a median) does not run out of memory.
+DEFAULT_ALIGNED_MAX_BYTES = 1024 * 1024 * 1024
+
+# Downscale factors images can be decoded at, and the matching reduced-resolution imread flags.
+# JPEG decoders can skip most of the work at these scales.
+SUPPORTED_SCALES = (1, 2, 4, 8)
+REDUCED_READ_FLAGS = {
+    2: getattr(cv2, 'IMREAD_REDUCED_COLOR_2', None),
+    4: getattr(cv2, 'IMREAD_REDUCED_COLOR_4', None),
+    8: getattr(cv2, 'IMREAD_REDUCED_COLOR_8', None),
+}
+
+
+def reduced_decode_scale(scale):
+    """
+    Return 'scale' rounded to an integer if images can be decoded at 1/scale of their
+    resolution and that is below full resolution, else None.
+    """
+    scale = int(round(scale))
+    if scale > 1 and scale in SUPPORTED_SCALES:
+        return scale
+    return None
+
+
+def read_image(path, scale=1):
+    """
+    Decode the image at path, downscaled by 'scale' (one of SUPPORTED_SCALES).
+    Uses the reduced-resolution imread flags when OpenCV has them (3.2+), and otherwise
+    decodes at full resolution and resizes.
+    """
+    with Profiler.stage('decode', path=path, scale=scale):
+        if scale == 1:
+            return cv2.imread(path)
+
+        if REDUCED_READ_FLAGS[scale] is not None:
+            return cv2.imread(path, REDUCED_READ_FLAGS[scale])
+
+        image = cv2.imread(path)
+        if image is None:
+            return None
+        size = ((image.shape[1] + scale - 1) // scale, (image.shape[0] + scale - 1) // scale)
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
 
 
 class ImageSource:
 
-    def __init__(self):
+    def __init__(self, cache_max_bytes=DEFAULT_CACHE_MAX_BYTES, aligned_max_bytes=DEFAULT_ALIGNED_MAX_BYTES):
+        """
+        :param cache_max_bytes: memory budget for decoded secondary images and reduced-resolution
+            images. They are decoded on first access and the least recently used ones are dropped
+            past this budget.
+        :param aligned_max_bytes: memory budget for aligned secondary images and their masks.
+            Images stored past this budget are written to temporary np.memmap files instead, which
+            the OS pages in as they are sliced.
+        """
         self.primary_image = None
-        self.secondary_images = []
+        self.primary_image_path = None
+        self.secondary_image_paths = []
+        self.secondary_image_cache = LruCache(max_bytes=cache_max_bytes)
         self.aligned_secondary_images = {}
+        self.aligned_secondary_masks = {}
+        self.aligned_max_bytes = aligned_max_bytes
+        self.aligned_bytes = 0
+        self.aligned_lock = threading.Lock()
+
+        # Decode time in seconds of each file decoded by the last preload, and of the whole preload
+        self.load_timings = {}
+        self.total_load_time = 0
 
         # Intermediate result image
         self.result_image = None
 
 
-    def load_images(self, folder_path):
+    def load_images(self, folder_path, preload=False, num_workers=None):
         """
         Load images in the folder path provided.
         Return true if
@@ -25,6 +99,11 @@ class ImageSource:
             Each folder will have one "Primary.ext" image and at least one "Secondary-x.ext" image,
             where x corresponds to the image number.
             :param folder_path: String
+
+        Only the primary image is decoded here. Secondary images are indexed by path and decoded
+        by get_secondary_image() when first needed, unless preload is set: then the primary and
+        every secondary image are decoded on a pool of num_workers threads (defaults to the
+        number of cores) before returning. See preload_images().
         """
 
         # Most image load comes from Assignment 8 test script
@@ -32,21 +111,81 @@ class ImageSource:
         extensions = ['.bmp', '.pbm', '.pgm', '.ppm', '.sr', '.ras', '.jpeg',
                       '.jpg', '.jpe', '.jp2', '.tiff', '.tif', '.png']
 
-        secondary_names_to_sort = []
+        self.primary_image = None
+        self.primary_image_path = None
+        self.secondary_image_paths = []
+        self.secondary_image_cache.clear()
+        with self.aligned_lock:
+            self.aligned_secondary_images = {}
+            self.aligned_secondary_masks = {}
+            self.aligned_bytes = 0
+        self.result_image = None
+
         for dir_name, dir_names, file_names in os.walk(folder_path):
+            secondary_names_to_sort = []
             for filename in file_names:
                 name, ext = os.path.splitext(filename)
                 if ext.lower() in extensions:
                     if name.lower() == 'primary':
-                        self.primary_image = cv2.imread(os.path.join(dir_name, filename))
+                        self.primary_image_path = os.path.join(dir_name, filename)
                     elif 'secondary-' in name.lower():
                         secondary_names_to_sort.append(filename)
             secondary_names_to_sort = self.__natural_sort(secondary_names_to_sort)
             for secondary in secondary_names_to_sort:
-                self.secondary_images.append(cv2.imread(os.path.join(dir_name, secondary)))
+                self.secondary_image_paths.append(os.path.join(dir_name, secondary))
+
+        if preload:
+            self.preload_images(self.primary_image_path, num_workers)
+        elif self.primary_image_path is not None:
+            self.primary_image = read_image(self.primary_image_path)
+
+        return self.primary_image is not None and len(self.secondary_image_paths) > 0
+
+
+    def preload_images(self, primary_image_path, num_workers=None):
+        """
+        Decode the primary image and all indexed secondary images concurrently.
+        cv2.imread releases the GIL, so decoding scales with threads. The secondary images keep
+        their natural-sort indices and go into the secondary image cache.
+        Per file timings are stored in load_timings and the total in total_load_time.
+        """
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+
+        paths = list(self.secondary_image_paths)
+        if primary_image_path is not None:
+            paths.append(primary_image_path)
 
-        # is not [] is only necessary if you want the boolean and not the falsy/truthy value
-        return self.primary_image is not None and self.secondary_images is not []
+        def decode(path):
+            start = time.time()
+            image = read_image(path)
+            return path, image, time.time() - start
+
+        start = time.time()
+        pool = ThreadPool(num_workers)
+        try:
+            results = pool.map(decode, paths)
+        finally:
+            pool.close()
+            pool.join()
+        self.total_load_time = time.time() - start
+
+        self.load_timings = {}
+        for path, image, elapsed in results:
+            self.load_timings[path] = elapsed
+            print "[INFO] Decoded %s in %.1fms" % (path, elapsed * 1000)
+
+            if path == primary_image_path:
+                self.primary_image = image
+            elif image is not None:
+                self.secondary_image_cache.put((path, 1), image)
+
+        print "[INFO] Decoded %d images in %.1fms with %d threads" % (len(paths), self.total_load_time * 1000,
+                                                                     num_workers)
+
+        if len(self.secondary_image_cache) < len(self.secondary_image_paths):
+            print "[WARNING] ImageSource::preload_images() - Not all secondary images fit in the cache, " \
+                  "the rest will be decoded again on access"
 
 
     # Added to sort the files for 1 vs 01 vs 10, etc
@@ -57,27 +196,109 @@ class ImageSource:
         return sorted(l, key = alphanum_key)
 
 
-    def get_primary_image(self):
-        return self.primary_image
+    def get_primary_image(self, scale=1):
+        """
+        Return the primary image, or with scale > 1 the primary image decoded at 1/scale of
+        its resolution (see read_image()).
+        """
+        if scale == 1 or self.primary_image_path is None:
+            return self.primary_image
+        return self.__get_cached_image(self.primary_image_path, scale)
 
 
     def get_number_of_secondary_images(self):
-        return len(self.secondary_images)
+        return len(self.secondary_image_paths)
 
 
-    def get_secondary_image(self, index):
-        if index < len(self.secondary_images):
-            return self.secondary_images[index]
-        return None
+    def get_secondary_image(self, index, scale=1):
+        """
+        Return the secondary image at index, decoded at 1/scale of its resolution.
+        Each scale is decoded and cached separately, so previews and coarse alignment never
+        decode the full resolution image.
+        """
+        if index not in range(len(self.secondary_image_paths)):
+            return None
+
+        return self.__get_cached_image(self.secondary_image_paths[index], scale)
+
+
+    def __get_cached_image(self, path, scale):
+        if scale not in SUPPORTED_SCALES:
+            print "[ERROR] ImageSource::__get_cached_image() - Unsupported scale: " + str(scale)
+            return None
+
+        image = self.secondary_image_cache.get((path, scale))
+        if image is None:
+            image = read_image(path, scale)
+            if image is None:
+                print "[ERROR] ImageSource::__get_cached_image() - Could not read " + path
+                return None
+            self.secondary_image_cache.put((path, scale), image)
 
+        return image
+
+
+    def get_cache_statistics(self):
+        """
+        Return the hit/miss/eviction counters and memory use of the decoded image cache.
+        """
+        return self.secondary_image_cache.get_statistics()
+
+
+    def set_aligned_secondary_image(self, image, index, mask=None):
+        """
+        Store the aligned secondary image at index, with the mask of the pixels the warp covered
+        (see ImageAligner.align_image(return_mask=True)), or None if it is not known.
+        Past aligned_max_bytes, they are stored as np.memmap arrays.
+        """
+        with self.aligned_lock:
+            # Replacing an image frees its memory
+            self.aligned_bytes -= self.__bytes_in_memory(self.aligned_secondary_images.get(index))
+            self.aligned_bytes -= self.__bytes_in_memory(self.aligned_secondary_masks.get(index))
 
-    def set_aligned_secondary_image(self, image, index):
-        self.aligned_secondary_images[index] = image
+            size = nbytes_of(image) + nbytes_of(mask)
+            spill = self.aligned_bytes + size > self.aligned_max_bytes
+            if not spill:
+                self.aligned_bytes += size
+
+        if spill:
+            image = self.__to_memmap(image)
+            mask = self.__to_memmap(mask)
+
+        with self.aligned_lock:
+            self.aligned_secondary_images[index] = image
+            self.aligned_secondary_masks[index] = mask
+
+
+    def __bytes_in_memory(self, image):
+        if image is None or isinstance(image, np.memmap):
+            return 0
+        return image.nbytes
+
+
+    def __to_memmap(self, image):
+        """
+        Return a copy of image in a temporary np.memmap file.
+        """
+        if image is None:
+            return None
+
+        (handle, path) = tempfile.mkstemp(prefix='aligned-', suffix='.npy')
+        os.close(handle)
+        try:
+            spilled_image = create_image_memmap(path, image.shape, image.dtype)
+            spilled_image[:] = image
+            spilled_image.flush()
+        finally:
+            # The mapping keeps the file's data until the array is dropped, so nothing is left behind
+            os.remove(path)
+
+        return spilled_image
 
 
     def get_aligned_secondary_image(self, index):
         # Boundary checking on index
-        if index not in range(len(self.secondary_images)):
+        if index not in range(len(self.secondary_image_paths)):
             return None
 
         # If the aligned secondary image does not exist, return None
@@ -87,6 +308,14 @@ class ImageSource:
         return self.aligned_secondary_images[index]
 
 
+    def get_aligned_secondary_mask(self, index):
+        """
+        Return the mask of the pixels covered by the aligned secondary image at index, or None
+        if the image is not aligned or was stored without a mask.
+        """
+        return self.aligned_secondary_masks.get(index)
+
+
     def get_result_image(self):
         if self.result_image is None:
             return self.primary_image
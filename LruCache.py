@@ -0,0 +1,121 @@
+import collections
+import hashlib
+import threading
+import numpy as np
+
+
+def image_digest(image):
+    """
+    Return a key that identifies the contents of a numpy image.
+    Two arrays with the same shape, type and pixels get the same key.
+    """
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha1(image.view(np.uint8)).hexdigest()
+    return (digest, image.shape, image.dtype.str)
+
+
+def nbytes_of(value):
+    """
+    Size in bytes of a numpy array, or of a (nested) list/tuple/dict of them.
+    Anything else counts as 0.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes_of(item) for item in value)
+    if isinstance(value, dict):
+        return sum(nbytes_of(item) for item in value.values())
+    return 0
+
+
+class LruCache:
+    """
+    Thread safe least-recently-used cache, bounded by number of entries and/or
+    total size in bytes, with hit/miss/eviction counters.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, size_function=nbytes_of):
+        """
+        :param max_entries: maximum number of entries, None for no limit
+        :param max_bytes: maximum total size_function() of the entries, None for no limit
+        :param size_function: returns the size in bytes of a cached value
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_function = size_function
+
+        self.entries = collections.OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        """
+        Return the value cached for key and mark it as most recently used.
+        Return None if the key is not cached.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            value, size = self.entries.pop(key)
+            self.entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+
+    def put(self, key, value):
+        """
+        Cache value for key, evicting least recently used entries to stay within
+        the limits. A value larger than max_bytes on its own is not cached.
+        """
+        size = self.size_function(value)
+
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size)
+            self.current_bytes += size
+
+            while (self.max_entries is not None and len(self.entries) > self.max_entries) or \
+                    (self.max_bytes is not None and self.current_bytes > self.max_bytes):
+                evicted_key, (evicted_value, evicted_size) = self.entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+
+    def get_statistics(self):
+        """
+        Return a dict with the counters and current size of the cache.
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+            }
@@ -0,0 +1,82 @@
+import multiprocessing
+import sys
+import time
+import cv2
+import numpy as np
+import ImageBlender
+from ImageMask import ImageMask
+from ImageSource import ImageSource
+from LruCache import nbytes_of
+import Profiler
+
+# Upscale factor of the dataset images, to get closer to camera resolutions
+SCALE = 3
+
+# Pyramid cache budget large enough to keep both Laplacian pyramids of any precision, to measure them
+PYRAMID_CACHE_MAX_BYTES = 8 * 1024 * 1024 * 1024
+
+
+def load_pair(dataset, scale):
+    image_source = ImageSource()
+    if not image_source.load_images(dataset):
+        return None, None
+
+    primary_image = image_source.get_primary_image()
+    if scale != 1:
+        size = (primary_image.shape[1] * scale, primary_image.shape[0] * scale)
+        return cv2.resize(primary_image, size), cv2.resize(image_source.get_secondary_image(0), size)
+    return primary_image, image_source.get_secondary_image(0)
+
+
+def blend_with_precision(precision, dataset, scale, result_queue):
+    """
+    Blend the first secondary image of dataset into its primary image with 'precision', in its own
+    process so the peak RSS is that of this blend. Put (output, seconds, pyramid_bytes, peak_rss_mb)
+    on result_queue.
+    """
+    white_image, black_image = load_pair(dataset, scale)
+    mask = ImageMask(white_image.shape).add_rectangle(white_image.shape[1] // 3, white_image.shape[0] // 3,
+                                                      white_image.shape[1] // 3, white_image.shape[0] // 3)
+
+    # The cache holds the two Laplacian pyramids the blend built
+    image_blender = ImageBlender.ImageBlender(pyramid_cache_max_bytes=PYRAMID_CACHE_MAX_BYTES, precision=precision)
+    start = time.time()
+    output = image_blender.blend(white_image, black_image, mask)
+    elapsed = time.time() - start
+    pyramid_bytes = sum(nbytes_of(value) for value, size in image_blender.pyramid_cache.entries.values())
+
+    peak_rss_mb = Profiler.peak_rss_mb()
+
+    result_queue.put((output, elapsed, pyramid_bytes, peak_rss_mb))
+
+
+def run_benchmark(dataset, scale):
+    """
+    Print, for every precision, the blend time, Laplacian pyramid memory, peak RSS and the error
+    against the float64 blend.
+    """
+    results = {}
+    for precision in ImageBlender.PRECISIONS:
+        result_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=blend_with_precision, args=(precision, dataset, scale, result_queue))
+        process.start()
+        results[precision] = result_queue.get()
+        process.join()
+
+    reference = results['float64'][0].astype(np.int16)
+    print "%s x%d (%dx%d)" % (dataset, scale, reference.shape[1], reference.shape[0])
+    print "  %-8s %10s %12s %10s %10s %10s %10s" % \
+        ("type", "time", "pyramids", "peak rss", "max err", "mean err", "differ")
+
+    for precision in ImageBlender.PRECISIONS:
+        output, elapsed, pyramid_bytes, peak_rss_mb = results[precision]
+        error = np.abs(output.astype(np.int16) - reference)
+        print "  %-8s %8.0fms %10.1fMB %8.0fMB %10d %10.6f %9.4f%%" % \
+            (precision, elapsed * 1000, pyramid_bytes / (1024.0 * 1024.0), peak_rss_mb,
+             error.max(), error.mean(), 100.0 * np.count_nonzero(error) / error.size)
+
+
+if __name__ == "__main__":
+    datasets = sys.argv[1:] if len(sys.argv) > 1 else ["./sailboat"]
+    for dataset in datasets:
+        run_benchmark(dataset, SCALE)
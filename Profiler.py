@@ -0,0 +1,334 @@
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# Profiler that stage() records into, None when profiling is off
+_active_profiler = None
+
+# Per thread stack of the stages being run, to tell nested stages from top level ones
+_thread_stages = threading.local()
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of the process so far, in megabytes. It is the high-water
+    mark of the whole process, so it never goes down.
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on OS X
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss / (1024.0 * 1024.0)
+    return peak_rss / 1024.0
+
+
+def cpu_seconds():
+    """
+    Return the user + system CPU time of the process. It includes the time of every thread.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def _stage_stack():
+    if not hasattr(_thread_stages, 'stack'):
+        _thread_stages.stack = []
+    return _thread_stages.stack
+
+
+class _Stage:
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        stack = _stage_stack()
+        self.parent = stack[-1] if len(stack) > 0 else None
+        self.depth = len(stack)
+        stack.append(self)
+
+        # Time spent in stages nested in this one, subtracted for its self time
+        self.children_wall = 0.0
+        self.children_cpu = 0.0
+
+        self.start_rss = peak_rss_mb()
+        self.start_cpu = cpu_seconds()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time()
+        end_cpu = cpu_seconds()
+        end_rss = peak_rss_mb()
+
+        _stage_stack().pop()
+        wall = end - self.start
+        cpu = end_cpu - self.start_cpu
+        if self.parent is not None:
+            self.parent.children_wall += wall
+            self.parent.children_cpu += cpu
+
+        self.profiler.record({
+            'name': self.name,
+            'args': self.args,
+            'thread': threading.current_thread().name,
+            'thread_id': threading.current_thread().ident,
+            'parent': self.parent.name if self.parent is not None else None,
+            'depth': self.depth,
+            'start': self.start,
+            'wall_seconds': wall,
+            'self_wall_seconds': wall - self.children_wall,
+            'cpu_seconds': cpu,
+            'self_cpu_seconds': cpu - self.children_cpu,
+            'process_peak_rss_mb': end_rss,
+            'process_peak_rss_growth_mb': end_rss - self.start_rss,
+        })
+        return False
+
+
+def stage(name, **args):
+    """
+    Return a context manager that records the block it wraps as stage 'name' in the active
+    Profiler, with 'args' (e.g. level=2) as details. Does nothing when no profiler is active.
+
+        with Profiler.stage('reduce', level=level):
+            ...
+    """
+    profiler = _active_profiler
+    if profiler is None:
+        return _NULL_STAGE
+    return _Stage(profiler, name, args)
+
+
+def add_arguments(parser):
+    """
+    Add the --profile, --trace and --cprofile options to an argparse parser.
+    """
+    parser.add_argument('--profile', metavar='REPORT.json', help="write a JSON report of the time spent per stage")
+    parser.add_argument('--trace', metavar='TRACE.json', help="write a Chrome trace of the stages")
+    parser.add_argument('--cprofile', metavar='STATS.prof', help="write cProfile statistics of the main thread")
+
+
+def start_from_arguments(arguments):
+    """
+    Return a started Profiler if any of the add_arguments() options is set, else None.
+    """
+    if arguments.profile is None and arguments.trace is None and arguments.cprofile is None:
+        return None
+
+    profiler = Profiler(use_cprofile=arguments.cprofile is not None)
+    profiler.start()
+    return profiler
+
+
+def stop_and_write(profiler, arguments):
+    """
+    Stop a profiler from start_from_arguments(), print its summary and write the requested outputs.
+    """
+    if profiler is None:
+        return
+
+    profiler.stop()
+    profiler.print_summary()
+
+    if arguments.profile is not None:
+        profiler.write_report(arguments.profile)
+    if arguments.trace is not None:
+        profiler.write_chrome_trace(arguments.trace)
+    if arguments.cprofile is not None:
+        profiler.write_cprofile(arguments.cprofile)
+
+
+class Profiler:
+    """
+    Records the wall time, CPU time and peak RSS growth of every stage() run between start() and
+    stop(), on any thread.
+
+    Stages nest, e.g. 'reduce' runs inside 'command'. Each event has its inclusive time and its
+    self time, without the stages nested in it on the same thread. Run totals only add up top
+    level stages, so nested time is not counted twice. Stages of worker threads are top level in
+    their thread, so they overlap the stage waiting for them on another thread.
+
+    Python 2 has no tracemalloc, so memory is the process-wide peak RSS, a high-water mark: the
+    mark at the end of a stage, and how much it rose during the stage. A rise may come from
+    another thread, and a stage that allocates below the mark shows none. CPU time is that of
+    the whole process, so with stages running on several threads it also counts the other
+    threads' work.
+
+    The events are available as a JSON report with totals per stage, and as a Chrome trace
+    (chrome://tracing). With use_cprofile, the thread that calls start() is also profiled by
+    cProfile.
+    """
+
+    def __init__(self, use_cprofile=False):
+        self.events = []
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.stop_time = None
+
+        self.cprofile = None
+        if use_cprofile:
+            self.cprofile = cProfile.Profile()
+
+
+    def start(self):
+        """
+        Make this the profiler stage() records into.
+        """
+        global _active_profiler
+        _active_profiler = self
+        self.start_time = time.time()
+
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+
+    def stop(self):
+        global _active_profiler
+        if self.cprofile is not None:
+            self.cprofile.disable()
+
+        self.stop_time = time.time()
+        if _active_profiler is self:
+            _active_profiler = None
+
+
+    def record(self, event):
+        with self.lock:
+            self.events.append(event)
+
+
+    def get_stage_totals(self):
+        """
+        Return a dict per stage name with its number of calls, total inclusive and self wall and
+        CPU time, and the largest process peak RSS growth during a single call.
+        """
+        totals = {}
+        with self.lock:
+            for event in self.events:
+                total = totals.setdefault(event['name'], {
+                    'calls': 0, 'wall_seconds': 0.0, 'self_wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                    'self_cpu_seconds': 0.0, 'max_process_peak_rss_growth_mb': 0.0})
+                total['calls'] += 1
+                total['wall_seconds'] += event['wall_seconds']
+                total['self_wall_seconds'] += event['self_wall_seconds']
+                total['cpu_seconds'] += event['cpu_seconds']
+                total['self_cpu_seconds'] += event['self_cpu_seconds']
+                total['max_process_peak_rss_growth_mb'] = max(total['max_process_peak_rss_growth_mb'],
+                                                              event['process_peak_rss_growth_mb'])
+        return totals
+
+
+    def get_top_level_totals(self):
+        """
+        Return the number of calls and total wall and CPU time of the top level stages only,
+        the time covered by stages without counting nested ones twice.
+        """
+        total = {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0}
+        with self.lock:
+            for event in self.events:
+                if event['depth'] == 0:
+                    total['calls'] += 1
+                    total['wall_seconds'] += event['wall_seconds']
+                    total['cpu_seconds'] += event['cpu_seconds']
+        return total
+
+
+    def get_report(self):
+        """
+        Return the run as a dict: total wall time, process peak RSS, totals of the top level
+        stages, totals per stage and every event.
+        """
+        with self.lock:
+            events = list(self.events)
+
+        stop_time = self.stop_time if self.stop_time is not None else time.time()
+        return {
+            'wall_seconds': stop_time - self.start_time if self.start_time is not None else 0.0,
+            'process_peak_rss_mb': peak_rss_mb(),
+            'top_level': self.get_top_level_totals(),
+            'stages': self.get_stage_totals(),
+            'events': events,
+        }
+
+
+    def write_report(self, filename):
+        with open(filename, 'w') as report_file:
+            json.dump(self.get_report(), report_file, indent=2, sort_keys=True)
+
+
+    def write_chrome_trace(self, filename):
+        """
+        Write the events in the Chrome trace event format, one row per thread.
+        """
+        with self.lock:
+            events = list(self.events)
+
+        origin = self.start_time if self.start_time is not None else min([event['start'] for event in events] or [0])
+        trace_events = []
+        for thread_id, thread in set((event['thread_id'], event['thread']) for event in events):
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread_id,
+                                 'args': {'name': thread}})
+
+        for event in events:
+            args = dict(event['args'])
+            args.update(cpu_seconds=event['cpu_seconds'], self_cpu_seconds=event['self_cpu_seconds'],
+                        self_wall_seconds=event['self_wall_seconds'],
+                        process_peak_rss_growth_mb=event['process_peak_rss_growth_mb'])
+            trace_events.append({
+                'name': event['name'],
+                'ph': 'X',
+                'ts': (event['start'] - origin) * 1e6,
+                'dur': event['wall_seconds'] * 1e6,
+                'pid': os.getpid(),
+                'tid': event['thread_id'],
+                'args': args,
+            })
+
+        with open(filename, 'w') as trace_file:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+    def write_cprofile(self, filename):
+        """
+        Write the cProfile statistics, for pstats or snakeviz. Needs use_cprofile.
+        """
+        if self.cprofile is None:
+            print "[ERROR] Profiler::write_cprofile() - Profiler was created without use_cprofile"
+            return
+        self.cprofile.dump_stats(filename)
+
+
+    def print_summary(self):
+        """
+        Print the stages sorted by total self time, then the top level totals. 'wall' and 'cpu'
+        include nested stages, 'self' does not. 'hwm+' is the largest rise of the process peak
+        RSS during a call.
+        """
+        totals = self.get_stage_totals()
+        print "[INFO] %-14s %7s %10s %10s %10s %10s" % ("stage", "calls", "self", "wall", "cpu", "hwm+")
+        for name in sorted(totals, key=lambda name: -totals[name]['self_wall_seconds']):
+            total = totals[name]
+            print "[INFO] %-14s %7d %8.1fms %8.1fms %8.1fms %8.1fMB" % \
+                (name, total['calls'], total['self_wall_seconds'] * 1000, total['wall_seconds'] * 1000,
+                 total['cpu_seconds'] * 1000, total['max_process_peak_rss_growth_mb'])
+
+        top_level = self.get_top_level_totals()
+        print "[INFO] %-14s %7d %10s %8.1fms %8.1fms, process peak RSS %.1fMB" % \
+            ("top level", top_level['calls'], "", top_level['wall_seconds'] * 1000, top_level['cpu_seconds'] * 1000,
+             peak_rss_mb())
@@ -0,0 +1,84 @@
+import sys
+import time
+import cv2
+import numpy as np
+import scipy.signal
+import ImageBlender
+
+REPEATS = 3
+
+
+def reference_reduce(image):
+    """
+    Full 5x5 convolve2d reduce, as used before the separable backends.
+    """
+    convolved_image = scipy.signal.convolve2d(image, ImageBlender.generatingKernel(0.4), 'same')
+    return convolved_image[::2, ::2]
+
+
+def reference_expand(image):
+    """
+    Full 5x5 convolve2d expand, as used before the separable backends.
+    """
+    up_sampled_image = np.zeros((image.shape[0] * 2, image.shape[1] * 2), dtype=image.dtype)
+    up_sampled_image[::2, ::2] = image
+    return 4 * scipy.signal.convolve2d(up_sampled_image, ImageBlender.generatingKernel(0.4), 'same')
+
+
+def time_call(function, *args):
+    """
+    Return the best wall time of REPEATS calls, in milliseconds.
+    """
+    best = None
+    for repeat in range(REPEATS):
+        start = time.time()
+        function(*args)
+        elapsed = (time.time() - start) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_benchmark(image):
+    """
+    Time reduce() and expand() at every level of the Gaussian pyramid of 'image'
+    with each convolution backend and with the reference convolve2d path.
+    """
+    min_size = min(image.shape)
+    depth = int(np.floor(np.log2(min_size))) - 4
+
+    implementations = [('convolve2d', reference_reduce, reference_expand)]
+    for backend in ImageBlender.CONVOLUTION_BACKENDS:
+        implementations.append((backend,
+                                lambda img, b=backend: ImageBlender.reduce(img, b),
+                                lambda img, b=backend: ImageBlender.expand(img, b)))
+
+    print "%-6s %-12s %-8s" % ("level", "size", "op"),
+    for name, reduce_function, expand_function in implementations:
+        print "%12s" % name,
+    print "%10s" % "best gain"
+
+    level_image = image
+    for level in range(depth + 1):
+        size = "%dx%d" % (level_image.shape[1], level_image.shape[0])
+
+        for op_index, op_name in [(1, 'reduce'), (2, 'expand')]:
+            timings = [time_call(implementation[op_index], level_image) for implementation in implementations]
+            print "%-6d %-12s %-8s" % (level, size, op_name),
+            for timing in timings:
+                print "%10.2fms" % timing,
+            print "%9.1fx" % (timings[0] / min(timings[1:]))
+
+        level_image = ImageBlender.reduce(level_image)
+
+
+if __name__ == "__main__":
+
+    image_path = sys.argv[1] if len(sys.argv) > 1 else "./sources/primary.jpg"
+
+    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        print "[ERROR] PyramidBenchmark - Could not read image: " + image_path
+        sys.exit(1)
+
+    run_benchmark(image.astype(float))
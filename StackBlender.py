@@ -0,0 +1,127 @@
+import numpy as np
+import Profiler
+
+# Memory budget of one chunk of rows of the frame stack and its workspace, see StackBlender.median()
+DEFAULT_CHUNK_MAX_BYTES = 256 * 1024 * 1024
+
+
+def masked_median(stack, valid_counts):
+    """
+    Return the per-pixel median over axis 0 of a uint8 stack (frames, rows, cols[, channels]),
+    rounded half up, where each pixel only has its first valid_counts[row, col] samples in sorted
+    order. Pixels without any valid sample are 0.
+
+    The caller sets invalid samples to 255, so they sort after every valid one. Pixels are grouped
+    by their number of valid samples, and each group takes its middle samples with one partition,
+    so the cost grows linearly with the number of frames instead of sorting every pixel.
+
+    The stack is partitioned in place. Groups of pixels are gathered into a copy, so at most one
+    more stack worth of memory is used, and none when every pixel has the same count.
+    """
+    frame_count = stack.shape[0]
+    counts = valid_counts.reshape(-1)
+    samples = stack.reshape(frame_count, counts.size, -1)
+    output = np.zeros(samples.shape[1:], dtype=np.uint8)
+
+    min_count = counts.min()
+    max_count = counts.max()
+
+    for count in np.unique(counts):
+        if count == 0:
+            continue
+
+        lower = (count - 1) // 2
+        upper = count // 2
+
+        # Usually every frame covers the whole chunk, then no pixels need to be gathered
+        if min_count == max_count:
+            samples.partition([lower, upper], axis=0)
+            output[:] = (samples[lower].astype(np.uint16) + samples[upper] + 1) // 2
+            break
+
+        pixels = np.nonzero(counts == count)[0]
+        middle = samples[:, pixels]
+        middle.partition([lower, upper], axis=0)
+        output[pixels] = (middle[lower].astype(np.uint16) + middle[upper] + 1) // 2
+
+    return output.reshape(stack.shape[1:])
+
+
+class StackBlender:
+    """
+    Removes moving objects from a stack of aligned frames of the same scene by taking the
+    per-pixel median over the frames: a tourist who covers a pixel in less than half of the
+    frames is replaced by the background seen in the others.
+
+    The stack is processed in chunks of rows, so its memory is bounded by chunk_max_bytes
+    however many frames there are.
+    """
+
+    def __init__(self, chunk_max_bytes=DEFAULT_CHUNK_MAX_BYTES):
+        self.chunk_max_bytes = chunk_max_bytes
+
+
+    def median(self, primary_image, aligned_images, valid_masks=None, progress_callback=None):
+        """
+        Return the per-pixel median of the primary image and the aligned secondary images.
+
+        'valid_masks' holds, for each aligned image, the single channel mask that is non zero where
+        the warp covered it (see ImageAligner.align_image(return_mask=True)), or None when the whole
+        image is valid. Pixels outside an image's mask are left out of the median, and every pixel
+        of the primary image counts. The images and masks are only sliced, so they can be np.memmap
+        arrays.
+        'progress_callback(done, total)', if given, is called after every chunk.
+        """
+        if primary_image is None:
+            print "[ERROR] StackBlender::median() - Primary image is None"
+            return None
+
+        if valid_masks is None:
+            valid_masks = [None] * len(aligned_images)
+
+        if len(valid_masks) != len(aligned_images):
+            print "[ERROR] StackBlender::median() - There must be one valid mask per aligned image"
+            return None
+
+        frames = [(primary_image, None)] + [(image, mask) for image, mask in zip(aligned_images, valid_masks)
+                                            if image is not None]
+        for image, mask in frames:
+            if image.shape != primary_image.shape or (mask is not None and mask.shape[:2] != image.shape[:2]):
+                print "[ERROR] StackBlender::median() - The sizes of the images are not equal"
+                return None
+
+        (rowCount, colCount) = primary_image.shape[:2]
+        row_bytes = primary_image[0].nbytes
+        stack_row_bytes = len(frames) * row_bytes
+        # Per row of a chunk: the stack, the copy of a group of pixels in masked_median() (at most
+        # the stack again), the uint16 sum of the middle samples, the valid counts and one frame's
+        # invalid pixels
+        chunk_row_bytes = 2 * stack_row_bytes + 4 * row_bytes + 3 * colCount
+        chunk_rows = max(1, min(rowCount, self.chunk_max_bytes // chunk_row_bytes))
+
+        output = np.empty_like(primary_image)
+        chunks = range(0, rowCount, chunk_rows)
+
+        for index, top in enumerate(chunks):
+            rows = slice(top, min(top + chunk_rows, rowCount))
+            with Profiler.stage('median', top=top):
+                stack = np.empty((len(frames),) + primary_image[rows].shape, dtype=np.uint8)
+                valid_counts = np.zeros(stack.shape[1:3], dtype=np.uint16)
+
+                for frame, (image, mask) in enumerate(frames):
+                    stack[frame] = image[rows]
+                    if mask is None:
+                        valid_counts += 1
+                        continue
+
+                    # All channels of a pixel share its validity
+                    invalid = np.asarray(mask[rows]) == 0
+                    stack[frame][invalid] = 255
+                    valid_counts += ~invalid
+
+                output[rows] = masked_median(stack, valid_counts)
+
+            if progress_callback is not None:
+                progress_callback(index + 1, len(chunks))
+
+        return output
@@ -1,56 +1,266 @@
+from AsyncImageWriter import AsyncImageWriter
 from CommandLineExecutor import CommandLineExecutor
-from ImageAligner import ImageAligner
-from ImageBlender import ImageBlender
-from ImageSource import ImageSource
+from ImageAligner import ImageAligner, add_arguments as add_aligner_arguments, \
+    options_from_arguments as aligner_options_from_arguments
+from ImageBlender import ImageBlender, PRECISIONS, DEFAULT_PRECISION
+from ImageMask import ImageMask
+from ImageSource import ImageSource, read_image, reduced_decode_scale
+from StackBlender import StackBlender
+from multiprocessing.pool import ThreadPool
+import Profiler
+import argparse
+import multiprocessing
 import cv2
-import os
 
-DISPLAY_INTERMEDIATE_RESULTS = 1
 INTERMEDIATE_RESULTS_FOLDER = "./intermediate-results"
 
+# Intermediate images written to INTERMEDIATE_RESULTS_FOLDER:
+#   none  - nothing
+#   final - the latest blending result, replaced after every blend
+#   all   - every aligned image, blending mask and blending result
+INTERMEDIATE_OUTPUT_NONE = 'none'
+INTERMEDIATE_OUTPUT_FINAL = 'final'
+INTERMEDIATE_OUTPUT_ALL = 'all'
+INTERMEDIATE_OUTPUTS = (INTERMEDIATE_OUTPUT_NONE, INTERMEDIATE_OUTPUT_FINAL, INTERMEDIATE_OUTPUT_ALL)
+
+# Primary images, coarse decode scale and aligner of the worker processes used by AppInstance.align_all()
+_worker_primary_image = None
+_worker_coarse_primary_image = None
+_worker_coarse_scale = None
+_worker_image_aligner = None
+
+
+def _init_align_worker(primary_image, coarse_primary_image, coarse_scale, aligner_settings):
+    """
+    Set up a worker process: one ImageAligner with aligner_settings (its constructor arguments)
+    for all of the worker's tasks, with the primary image's features detected once up front.
+    coarse_primary_image and coarse_scale are as AppInstance.get_coarse_decode_scale() gives them.
+    """
+    global _worker_primary_image, _worker_coarse_primary_image, _worker_coarse_scale, _worker_image_aligner
+    _worker_primary_image = primary_image
+    _worker_coarse_primary_image = coarse_primary_image
+    _worker_coarse_scale = coarse_scale
+    _worker_image_aligner = ImageAligner(**aligner_settings)
+    _worker_image_aligner.precompute_features(primary_image, coarse_primary_image)
+
+
+def _align_in_worker(task):
+    """
+    Decode and align one secondary image in a worker process. task is (index, secondary_image_path).
+    Return (index, aligned_image, valid_mask), with None images if the file could not be read.
+    The coarse secondary image falls back to downscaling the full decode if it could not be read.
+    """
+    secondary_image_index, secondary_image_path = task
+    secondary_image = read_image(secondary_image_path)
+    coarse_secondary_image = None
+    if _worker_coarse_scale is not None:
+        coarse_secondary_image = read_image(secondary_image_path, _worker_coarse_scale)
+
+    if secondary_image is None:
+        return secondary_image_index, None, None
+
+    aligned_image, valid_mask = _worker_image_aligner.align_image(_worker_primary_image, secondary_image,
+                                                                  return_mask=True,
+                                                                  coarse_primary_image=_worker_coarse_primary_image,
+                                                                  coarse_secondary_image=coarse_secondary_image)
+    return secondary_image_index, aligned_image, valid_mask
+
+
 class AppInstance:
     """
     Class to bind everything together.
     """
 
-    def __init__(self):
+    def __init__(self, headless=False, intermediate_output=INTERMEDIATE_OUTPUT_ALL, precision=DEFAULT_PRECISION,
+                 aligner_options=None):
+        """
+        :param headless: never open HighGUI windows, for runs without a display
+        :param intermediate_output: which intermediate images to write, one of INTERMEDIATE_OUTPUTS.
+            They are written on a background thread, see flush_intermediate_results().
+        :param precision: sample type of the blending pyramids, see ImageBlender.PRECISIONS
+        :param aligner_options: dict of ImageAligner constructor arguments (coarse_level, refine_iterations,
+            matcher, num_features), see ImageAligner.options_from_arguments()
+        """
+        if intermediate_output not in INTERMEDIATE_OUTPUTS:
+            raise ValueError("Unknown intermediate output '%s', expected one of %s" %
+                             (intermediate_output, ', '.join(INTERMEDIATE_OUTPUTS)))
+
+        self.headless = headless
+        self.intermediate_output = intermediate_output
+        self.intermediate_writer = AsyncImageWriter()
         self.command_line_executor = CommandLineExecutor(self)
-        self.image_aligner = ImageAligner()
-        self.image_blender = ImageBlender()
+        self.image_aligner = ImageAligner(**(aligner_options or {}))
+        self.image_blender = ImageBlender(precision=precision)
         self.image_source = ImageSource()
+        self.stack_blender = StackBlender()
 
 
-    def run_as_commandline_app(self, commands):
+    def run_as_commandline_app(self, commands, num_workers=1):
+        """
+        Parse and run commands. With num_workers above 1 (None for the number of cores),
+        independent commands run concurrently, see CommandLineExecutor.execute_all_commands().
+        Intermediate results are then displayed from worker threads, so prefer a headless instance.
+        """
         self.command_line_executor.parse_commands(commands)
 
-        pending_commands = True
-        while pending_commands:
-            pending_commands = self.command_line_executor.execute_next_command()
+        try:
+            if num_workers != 1:
+                self.command_line_executor.execute_all_commands(num_workers)
+                return
+
+            pending_commands = True
+            while pending_commands:
+                pending_commands = self.command_line_executor.execute_next_command()
+        finally:
+            self.flush_intermediate_results()
+
+
+    def flush_intermediate_results(self):
+        """
+        Wait until every queued intermediate image is written.
+        """
+        self.intermediate_writer.flush()
+
+
+    def show_intermediate_result(self, window_title, image, filename=None):
+        """
+        Display image unless headless, and queue it to be written as 'filename' (defaults to
+        window_title) in INTERMEDIATE_RESULTS_FOLDER when intermediate_output is 'all'.
+        """
+        if not self.headless:
+            cv2.namedWindow(window_title, cv2.WINDOW_AUTOSIZE)
+            cv2.imshow(window_title, image)
+
+        if self.intermediate_output == INTERMEDIATE_OUTPUT_ALL:
+            self.intermediate_writer.write(INTERMEDIATE_RESULTS_FOLDER + "/" + (filename or window_title) + ".jpg",
+                                           image)
 
 
     def run_as_gui_app(self):
         pass
 
 
+    def show_intermediate_blending_result(self, window_title, result_image):
+        """
+        show_intermediate_result() for a new result image, which is also the one written when
+        intermediate_output is 'final'.
+        """
+        self.show_intermediate_result(window_title, result_image)
+
+        # A single file, so a queued older result is replaced instead of encoded
+        if self.intermediate_output == INTERMEDIATE_OUTPUT_FINAL:
+            self.intermediate_writer.write(INTERMEDIATE_RESULTS_FOLDER + "/Intermediate Blending Result.jpg",
+                                           result_image)
+
+
+    def get_coarse_decode_scale(self):
+        """
+        Return the scale images are decoded at for the aligner's coarse level, or None when the
+        aligner downscales full resolution images itself (coarse level 0, or beyond the reduced
+        decode scales).
+
+        Features are detected on images decoded at the coarse scale instead of downscaling full
+        decodes. Every alignment path must use the same coarse images, as features are cached
+        by image contents.
+        """
+        return reduced_decode_scale(2 ** self.image_aligner.coarse_level)
+
+
     def align_nth_secondary_image(self, secondary_image_index):
+        secondary_image_index, aligned_image, valid_mask = self.__align(secondary_image_index)
+        if aligned_image is None:
+            print "[ERROR] AppInstance::align_nth_secondary_image() - primary or secondary image is None"
+            return
+
+        self.store_aligned_image(aligned_image, secondary_image_index, valid_mask)
+
+
+    def align_all(self, num_workers=None, use_processes=False, indices=None):
+        """
+        Align every secondary image with the primary image on a pool of workers.
+        Aligned images are stored as they finish, in any order.
+        :param num_workers: pool size, defaults to the number of cores
+        :param use_processes: use worker processes instead of threads. OpenCV releases the GIL
+            while detecting and warping, so threads are usually enough and share the feature cache.
+            Worker processes decode the secondary images themselves, from their paths.
+        :param indices: indices of the secondary images to align, defaults to all of them
+        """
         primary_image = self.image_source.get_primary_image()
-        secondary_image = self.image_source.get_secondary_image(secondary_image_index)
+        secondary_count = self.image_source.get_number_of_secondary_images()
 
-        if primary_image is None or secondary_image is None:
-            print "[ERROR] AppInstance::align_nth_secondary_image() - primary or secondary image is None"
+        if primary_image is None or secondary_count == 0:
+            print "[ERROR] AppInstance::align_all() - primary image is None or there are no secondary images"
             return
 
-        aligned_image = self.image_aligner.align_image(primary_image, secondary_image)
-        self.image_source.set_aligned_secondary_image(aligned_image, secondary_image_index)
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+
+        if indices is None:
+            indices = range(secondary_count)
+
+        coarse_scale = self.get_coarse_decode_scale()
+        coarse_primary_image = None
+        if coarse_scale is not None:
+            coarse_primary_image = self.image_source.get_primary_image(coarse_scale)
+
+        if use_processes:
+            aligner_settings = {
+                'coarse_level': self.image_aligner.coarse_level,
+                'refine_iterations': self.image_aligner.refine_iterations,
+                'matcher': self.image_aligner.matcher,
+                'num_features': self.image_aligner.num_features,
+            }
+            pool = multiprocessing.Pool(num_workers, _init_align_worker,
+                                        (primary_image, coarse_primary_image, coarse_scale, aligner_settings))
+            align_task = _align_in_worker
+            tasks = [(index, self.image_source.secondary_image_paths[index]) for index in indices]
+        else:
+            # Detect the primary features once, before the workers all ask for them
+            self.image_aligner.precompute_features(primary_image, coarse_primary_image)
+            pool = ThreadPool(num_workers)
+            align_task = self.__align
+            tasks = indices
+
+        try:
+            for secondary_image_index, aligned_image, valid_mask in pool.imap_unordered(align_task, tasks):
+                if aligned_image is None:
+                    print "[ERROR] AppInstance::align_all() - secondary image " + str(secondary_image_index) + " is None"
+                    continue
+                self.store_aligned_image(aligned_image, secondary_image_index, valid_mask)
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def __align(self, secondary_image_index):
+        """
+        Align one secondary image, on the calling thread or an align_all() worker thread, like
+        _align_in_worker(). Return (index, aligned_image, valid_mask), with None images if the
+        primary or secondary image is missing.
+        """
+        primary_image = self.image_source.get_primary_image()
+        secondary_image = self.image_source.get_secondary_image(secondary_image_index)
+        if primary_image is None or secondary_image is None:
+            return secondary_image_index, None, None
+
+        coarse_scale = self.get_coarse_decode_scale()
+        coarse_primary_image = None
+        coarse_secondary_image = None
+        if coarse_scale is not None:
+            coarse_primary_image = self.image_source.get_primary_image(coarse_scale)
+            coarse_secondary_image = self.image_source.get_secondary_image(secondary_image_index, coarse_scale)
 
-        if DISPLAY_INTERMEDIATE_RESULTS:
-            window_title = "Intermediate Aligning Result (#" + str(secondary_image_index) + ")"
-            cv2.namedWindow(window_title, cv2.WINDOW_AUTOSIZE)
-            cv2.imshow(window_title, aligned_image)
+        aligned_image, valid_mask = self.image_aligner.align_image(primary_image, secondary_image, return_mask=True,
+                                                                   coarse_primary_image=coarse_primary_image,
+                                                                   coarse_secondary_image=coarse_secondary_image)
+        return secondary_image_index, aligned_image, valid_mask
 
-            if not os.path.exists(INTERMEDIATE_RESULTS_FOLDER):
-                os.makedirs(INTERMEDIATE_RESULTS_FOLDER)
-            cv2.imwrite(INTERMEDIATE_RESULTS_FOLDER + "/" + window_title + ".jpg", aligned_image)
+
+    def store_aligned_image(self, aligned_image, secondary_image_index, valid_mask=None):
+        self.image_source.set_aligned_secondary_image(aligned_image, secondary_image_index, valid_mask)
+
+        self.show_intermediate_result("Intermediate Aligning Result (#" + str(secondary_image_index) + ")",
+                                      aligned_image)
 
 
     def blend_nth_secondary_image(self, secondary_image_index, x, y, width, height):
@@ -62,22 +272,17 @@ class AppInstance:
             return
 
         mask_size = (previous_result_image.shape[0], previous_result_image.shape[1])
-        mask_coordinates = (x, y, width, height)
 
-        # Create a mask
-        mask = self.image_blender.create_rectangular_mask(mask_size, mask_coordinates)
-
-        if DISPLAY_INTERMEDIATE_RESULTS:
-            window_title = "Intermediate Blending Mask (#" + str(secondary_image_index) + ")"
-            cv2.namedWindow(window_title, cv2.WINDOW_AUTOSIZE)
-            cv2.imshow(window_title, mask)
+        # Create a mask. It is only rendered for display, the blend builds its pyramid from the rectangle.
+        mask = ImageMask(mask_size).add_rectangle(x, y, width, height)
 
-            if not os.path.exists(INTERMEDIATE_RESULTS_FOLDER):
-                os.makedirs(INTERMEDIATE_RESULTS_FOLDER)
-            cv2.imwrite(INTERMEDIATE_RESULTS_FOLDER + "/" + window_title + ".jpg", mask)
+        if not self.headless or self.intermediate_output == INTERMEDIATE_OUTPUT_ALL:
+            self.show_intermediate_result("Intermediate Blending Mask (#" + str(secondary_image_index) + ")",
+                                          mask.render())
 
-        # Blend the previous result with the secondary image
-        new_result_image = self.image_blender.blend(previous_result_image, secondary_image, mask)
+        # Blend the previous result with the secondary image. Only the area around the
+        # rectangle can change, so restrict the blend to it.
+        new_result_image = self.image_blender.blend_roi(previous_result_image, secondary_image, mask)
 
         if new_result_image is None:
             print "[ERROR] AppInstance::blend_nth_secondary_image() - blend result is None"
@@ -86,26 +291,70 @@ class AppInstance:
         # Update result image in image source
         self.image_source.set_result_image(new_result_image)
 
-        if DISPLAY_INTERMEDIATE_RESULTS:
-            window_title = "Intermediate Blending Result (#" + str(secondary_image_index) + ")"
-            cv2.namedWindow(window_title, cv2.WINDOW_AUTOSIZE)
-            cv2.imshow(window_title, new_result_image)
+        self.show_intermediate_blending_result("Intermediate Blending Result (#" + str(secondary_image_index) + ")",
+                                               new_result_image)
+
+
+    def median_all_images(self, num_workers=None):
+        """
+        Replace the result image by the per-pixel median of the primary image and every secondary
+        image, which removes people who move between the frames without any mask.
+        Secondary images that are not aligned yet are aligned first, see align_all().
+        """
+        primary_image = self.image_source.get_primary_image()
+        secondary_count = self.image_source.get_number_of_secondary_images()
+
+        if primary_image is None:
+            print "[ERROR] AppInstance::median_all_images() - primary image is None"
+            return
+
+        missing_indices = [index for index in range(secondary_count)
+                           if self.image_source.get_aligned_secondary_image(index) is None]
+        if len(missing_indices) > 0:
+            self.align_all(num_workers, indices=missing_indices)
 
-            if not os.path.exists(INTERMEDIATE_RESULTS_FOLDER):
-                os.makedirs(INTERMEDIATE_RESULTS_FOLDER)
-            cv2.imwrite(INTERMEDIATE_RESULTS_FOLDER + "/" + window_title + ".jpg", new_result_image)
+        aligned_images = [self.image_source.get_aligned_secondary_image(index) for index in range(secondary_count)]
+        valid_masks = [self.image_source.get_aligned_secondary_mask(index) for index in range(secondary_count)]
+        new_result_image = self.stack_blender.median(primary_image, aligned_images, valid_masks)
+
+        if new_result_image is None:
+            print "[ERROR] AppInstance::median_all_images() - median result is None"
+            return
+
+        self.image_source.set_result_image(new_result_image)
+
+        self.show_intermediate_blending_result("Intermediate Median Result", new_result_image)
 
 
     def save_result(self, filename):
         result_image = self.image_source.get_result_image()
 
-        window_title = "Final Result"
-        cv2.namedWindow(window_title, cv2.WINDOW_AUTOSIZE)
-        cv2.imshow(window_title, result_image)
-        cv2.imwrite(filename, result_image)
+        if not self.headless:
+            window_title = "Final Result"
+            cv2.namedWindow(window_title, cv2.WINDOW_AUTOSIZE)
+            cv2.imshow(window_title, result_image)
+
+        with Profiler.stage('encode', path=filename):
+            return cv2.imwrite(filename, result_image)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remove tourists by blending aligned photos of a scene.")
+    parser.add_argument('--headless', action='store_true', help="do not open any window")
+    parser.add_argument('--intermediate', choices=INTERMEDIATE_OUTPUTS, default=INTERMEDIATE_OUTPUT_ALL,
+                        help="intermediate images to write to " + INTERMEDIATE_RESULTS_FOLDER +
+                             " (default %(default)s)")
+    parser.add_argument('--precision', choices=PRECISIONS, default=DEFAULT_PRECISION,
+                        help="sample type of the blending pyramids (default %(default)s)")
+    parser.add_argument('--cmd', nargs='+', action='append', metavar='ARGUMENT',
+                        help="command to run, e.g. --cmd load ./test1 --cmd median --cmd save ./test1/result.jpg, "
+                             "see CommandLineExecutor.parse_commands()")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="run independent commands on N threads, 0 for the number of cores "
+                             "(default %(default)s). Prefer --headless with more than one.")
+    add_aligner_arguments(parser)
+    Profiler.add_arguments(parser)
+    arguments = parser.parse_args()
 
     dir_path = "./coffee-table"
     commands = [
@@ -115,6 +364,9 @@ if __name__ == "__main__":
         '--cmd save "' + dir_path + '/result.jpg"',
     ]
 
+    if arguments.cmd is not None:
+        commands = ['--cmd ' + ' '.join(command) for command in arguments.cmd]
+
     """
     # For testing image aligner
     dir_path = "./test1"
@@ -129,8 +381,14 @@ if __name__ == "__main__":
     ]
     """
 
-    app_instance = AppInstance()
-    app_instance.run_as_commandline_app(commands)
+    profiler = Profiler.start_from_arguments(arguments)
+
+    app_instance = AppInstance(arguments.headless, arguments.intermediate, arguments.precision,
+                               aligner_options_from_arguments(arguments))
+    app_instance.run_as_commandline_app(commands, arguments.workers or None)
+
+    Profiler.stop_and_write(profiler, arguments)
 
     # Keep cv windows open until a key is pressed.
-    cv2.waitKey(0)
+    if not arguments.headless:
+        cv2.waitKey(0)
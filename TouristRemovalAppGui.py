@@ -1,27 +1,49 @@
 import sys
 import os
+import argparse
 from PyQt4.QtGui import *
+from BackgroundTask import BackgroundTask
 from CommandLineExecutor import CommandLineExecutor
-from ImageAligner import ImageAligner
+from ImageAligner import ImageAligner, add_arguments as add_aligner_arguments, \
+    options_from_arguments as aligner_options_from_arguments
 from ImageBlender import ImageBlender
-from ImageSource import ImageSource
+from ImageMask import ImageMask
+from ImageOverlay import ImageOverlay
+from ImageSource import ImageSource, reduced_decode_scale
 import cv2
 import scipy
 import numpy as np
 
+# Merge previews are blended at the largest 1/2**n scale of the primary image with at most this many pixels
+PREVIEW_MAX_PIXELS = 500000
+
+# Memory budget of the blender's pyramid cache, two 12 MP color images in float32. The same pair
+# is blended again for every preview and commit of a merge area.
+PYRAMID_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
 
 class TouristRemovalGui:
 
-    def __init__(self):
+    def __init__(self, aligner_options=None):
+        """
+        :param aligner_options: dict of ImageAligner constructor arguments, see
+            ImageAligner.options_from_arguments()
+        """
         self.primary = None
         self.output_highlight = None
         self.output_highlight_merge = None
         self.visible_image = None
 
+        # (primary, aligned secondary, mask) of the last merge, from the moment its preview is
+        # requested until it is blended at full resolution on commit or save. Its preview may
+        # still be blending, so this is not tied to the image on display.
+        self.pending_merge = None
+
         self.command_line_executor = CommandLineExecutor(self)
-        self.image_aligner = ImageAligner()
-        self.image_blender = ImageBlender()
+        self.image_aligner = ImageAligner(**(aligner_options or {}))
+        self.image_blender = ImageBlender(pyramid_cache_max_bytes=PYRAMID_CACHE_MAX_BYTES)
         self.image_source = ImageSource()
+        self.image_overlay = ImageOverlay()
         self.application = QApplication(sys.argv)
         self.window = QMainWindow()
         self.image_label = QLabel(self.window)
@@ -34,6 +56,7 @@ class TouristRemovalGui:
         self.button_highlighted_merged = QAction('Show Highlighted Merged Area', self.window)
         self.button_unaltered_primary = QAction('Show Unaltered Primary Image', self.window)
         self.button_merge = QAction('Merge', self.window)
+        self.button_commit_merge = QAction('Commit Merge', self.window)
         self.button_set_primary = QAction('Set New Primary', self.window)
 
         self.button_update_merge = QPushButton('Update Merge Area', self.window)
@@ -45,12 +68,22 @@ class TouristRemovalGui:
 
         self.int_validator = None
 
+        # Align/blend jobs run on worker threads. Only the latest one is shown; starting a job
+        # cancels the previous preview. Alignment and full resolution commits are not cancelled,
+        # so actions requested while they run wait for them, in order. Running tasks are
+        # referenced until their thread finishes.
+        self.current_task = None
+        self.queued_actions = []
+        self.tasks = []
+        self.progress_bar = QProgressBar(self.window)
+
     def run(self):
         self.window.setFixedSize(320, 240)
         self.window.setWindowTitle("Tourist Removal App")
         self.setup_main_menu()
         self.setup_scroll_area_and_combo()
         self.setup_inputs()
+        self.setup_status_bar()
 
         self.window.show()
         sys.exit(self.application.exec_())
@@ -61,6 +94,11 @@ class TouristRemovalGui:
         self.input_width.setVisible(False)
         self.input_height.setVisible(False)
 
+    def setup_status_bar(self):
+        self.progress_bar.setVisible(False)
+        self.progress_bar.setFixedWidth(150)
+        self.window.statusBar().addPermanentWidget(self.progress_bar)
+
     def setup_scroll_area_and_combo(self):
         self.scroll_area.move(0, 20)
         self.scroll_area.setVisible(False)
@@ -82,6 +120,7 @@ class TouristRemovalGui:
         display_menu.addAction(self.build_show_hightlighed_merged_button())
         display_menu.addAction(self.build_show_unaltered_primary_button())
         display_menu.addAction(self.build_show_merged_button())
+        display_menu.addAction(self.build_commit_merge_button())
         display_menu.addAction(self.build_show_set_primary_button())
 
     def build_import_source_button(self):
@@ -125,6 +164,11 @@ class TouristRemovalGui:
         self.button_merge.setEnabled(False)
         return self.button_merge
 
+    def build_commit_merge_button(self):
+        self.button_commit_merge.triggered.connect(lambda: self.commit_merge())
+        self.button_commit_merge.setEnabled(False)
+        return self.button_commit_merge
+
     def build_show_set_primary_button(self):
         self.button_set_primary.triggered.connect(self.set_primary)
         self.button_set_primary.setEnabled(False)
@@ -134,8 +178,9 @@ class TouristRemovalGui:
         loaded = self.image_source.load_images(str(QFileDialog.getExistingDirectory(self.window, 'Open Source Folder')))
         if loaded:
             self.primary = self.image_source.primary_image
-            self.build_highlight_and_merged(0)
+            self.pending_merge = None
             self.set_label_image(self.primary)
+            self.build_highlight_and_merged(0)
 
             self.import_success_handler()
             print "Handle Success"
@@ -155,10 +200,10 @@ class TouristRemovalGui:
         height = min(shape[0], 900)
         buffer = 2
         self.scroll_area.setFixedSize(width + buffer, height + buffer)
-        self.window.setFixedSize(width + buffer, height + 80 + buffer)
+        self.window.setFixedSize(width + buffer, height + 100 + buffer)
 
         self.images_combo.setVisible(True)
-        for pos in range(len(self.image_source.secondary_images)):
+        for pos in range(self.image_source.get_number_of_secondary_images()):
             self.images_combo.addItem(str(pos))
         self.images_combo.move(20, height + 35)
         self.images_combo.setFixedWidth(50)
@@ -193,6 +238,7 @@ class TouristRemovalGui:
         self.button_highlighted_merged.setEnabled(True)
         self.button_unaltered_primary.setEnabled(True)
         self.button_merge.setEnabled(True)
+        self.button_commit_merge.setEnabled(True)
         self.button_set_primary.setEnabled(True)
 
     def convert_opencv_to_qimage (self, cv_img, show_merge = True):
@@ -210,22 +256,112 @@ class TouristRemovalGui:
             cv2.rectangle(img,(x, y),(x + w, y + h), (0, 255, 0))
         return QImage(img.data, width, height, bytes_per_line, QImage.Format_RGB888)
 
+    def queue_if_busy(self, action, message, kind=None):
+        """
+        If the current task cannot be cancelled, queue action() to run once it is done and return
+        True. Otherwise return False.
+        Queuing an action of a 'kind' drops the actions of that kind queued before it.
+        """
+        if self.current_task is None or self.current_task.cancellable:
+            return False
+
+        # Only the latest request of a kind runs, e.g. of an image the user flipped past
+        if kind is not None:
+            self.queued_actions = [(queued_kind, queued_action) for (queued_kind, queued_action) in self.queued_actions
+                                   if queued_kind != kind]
+
+        self.queued_actions.append((kind, action))
+        self.window.statusBar().showMessage(message)
+        return True
+
+    def run_queued_actions(self):
+        # An action that starts an alignment queues the ones after it again
+        actions = self.queued_actions
+        self.queued_actions = []
+        for (kind, action) in actions:
+            action()
+
+    def start_task(self, function, finished_handler, message, cancellable=True):
+        """
+        Run function(progress_callback) on a worker thread and call finished_handler(result) on
+        the GUI thread when it is done, unless another task was started in the meantime.
+        Pass cancellable False for work without progress reports, which cancel() cannot stop, and
+        for work the user is waiting for, like a save; callers use queue_if_busy() not to start
+        another task while it runs.
+        """
+        if self.current_task is not None:
+            self.current_task.cancel()
+
+        task = BackgroundTask(function, cancellable=cancellable)
+        task.progress_changed.connect(lambda done, total, t=task: self.show_task_progress(t, done, total))
+        task.task_finished.connect(lambda result, t=task: self.finish_task(t, result, finished_handler))
+        task.task_failed.connect(lambda error, t=task: self.fail_task(t, error))
+        task.finished.connect(lambda t=task: self.tasks.remove(t))
+        self.tasks.append(task)
+        self.current_task = task
+
+        self.window.statusBar().showMessage(message)
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.setVisible(True)
+        task.start()
+
+    def show_task_progress(self, task, done, total):
+        if task is self.current_task:
+            self.progress_bar.setRange(0, total)
+            self.progress_bar.setValue(done)
+
+    def finish_task(self, task, result, finished_handler):
+        if task is not self.current_task:
+            return
+        self.current_task = None
+        self.progress_bar.setVisible(False)
+        self.window.statusBar().clearMessage()
+        finished_handler(result)
+        self.run_queued_actions()
+
+    def fail_task(self, task, error):
+        if task is not self.current_task:
+            return
+        self.current_task = None
+        self.progress_bar.setVisible(False)
+        self.window.statusBar().showMessage("Error: " + error)
+        print "[ERROR] TouristRemovalGui::fail_task() - " + error
+        self.run_queued_actions()
+
     def handle_image_change (self, text):
         self.build_highlight_and_merged(int(text))
-        self.set_label_image(self.primary)
 
     def build_highlight_and_merged(self, index):
-        align = self.image_aligner.align_image(self.primary, self.image_source.secondary_images[index])
+        if self.queue_if_busy(lambda: self.build_highlight_and_merged(index),
+                              "Aligning image " + str(index) + " after the current one...", kind='align'):
+            return
+
+        primary = self.primary
+        use_reduced_decodes = primary is self.image_source.primary_image
+        self.start_task(lambda progress: self.align(primary, index, use_reduced_decodes),
+                        lambda align: self.show_aligned_image(align, index),
+                        "Aligning image " + str(index) + "...", cancellable=False)
+
+    def align(self, primary, index, use_reduced_decodes):
+        """
+        Align secondary image 'index' to 'primary'. With use_reduced_decodes, features are detected
+        on images decoded at the aligner's coarse scale. A primary image replaced by a merge result
+        only exists at full resolution, so the aligner downscales it instead.
+        """
+        secondary = self.image_source.get_secondary_image(index)
+        coarse_scale = reduced_decode_scale(2 ** self.image_aligner.coarse_level)
+        if coarse_scale is None or not use_reduced_decodes:
+            return self.image_aligner.align_image(primary, secondary)
+
+        return self.image_aligner.align_image(primary, secondary,
+                                              coarse_primary_image=self.image_source.get_primary_image(coarse_scale),
+                                              coarse_secondary_image=self.image_source.get_secondary_image(
+                                                  index, coarse_scale))
+
+    def show_aligned_image(self, align, index):
         self.image_source.set_aligned_secondary_image(align, index)
-        self.output_highlight = np.copy(self.primary)
-        self.output_highlight_merge = np.copy(self.primary)
-
-        for row in range(len(align)):
-            for col in range(len(align[0])):
-                if align[row][col][0] > 0:
-                    self.output_highlight_merge[row][col] = align[row][col]
-                    self.output_highlight_merge[row, col, 0:1] = 0
-                    self.output_highlight[row, col, 0:1] = 0
+        self.output_highlight, self.output_highlight_merge = self.image_overlay.build_highlights(self.primary, align)
+        self.set_label_image(self.primary)
 
     def update_merge(self):
         self.set_label_image(self.visible_image)
@@ -235,28 +371,97 @@ class TouristRemovalGui:
         return int(s) if s else 0
 
     def merge(self):
+        if self.queue_if_busy(self.merge, "Merging once the current task is done..."):
+            return
+
         mask_size = (self.primary.shape[0], self.primary.shape[1])
         x = self.tr_int(self.input_x.text())
         y = self.tr_int(self.input_y.text())
         w = self.tr_int(self.input_width.text())
         h = self.tr_int(self.input_height.text())
-        mask_coordinates = (x, y, w, h)
-
-        mask = self.image_blender.create_rectangular_mask(mask_size, mask_coordinates)
-
-        new_result_image = self.image_blender.blend(self.primary, self.image_source.aligned_secondary_images[int(self.images_combo.currentText())], mask)
+        mask = ImageMask(mask_size).add_rectangle(x, y, w, h)
+
+        aligned = self.image_source.get_aligned_secondary_image(int(self.images_combo.currentText()))
+        if aligned is None:
+            self.window.statusBar().showMessage("The selected image is still being aligned")
+            return
+
+        # Show a low resolution preview. The full resolution blend runs on commit or save, which
+        # may come before the preview is done.
+        primary = self.primary
+        self.pending_merge = (primary, aligned, mask)
+        use_reduced_decodes = primary is self.image_source.primary_image
+        self.start_task(lambda progress: self.blend_preview(primary, aligned, mask, use_reduced_decodes, progress),
+                        self.show_merge_preview,
+                        "Blending preview...")
+
+    def blend_preview(self, primary, aligned, mask, use_reduced_decodes, progress):
+        """
+        Blend the merge at the preview scale and return it resized to full size. With
+        use_reduced_decodes the primary image is decoded at the preview scale. The aligned
+        image only exists at full resolution and is downscaled.
+        """
+        scale = self.preview_scale(primary)
+        primary_preview = None
+        decode_scale = reduced_decode_scale(1 / scale)
+        if decode_scale is not None and use_reduced_decodes:
+            primary_preview = self.image_source.get_primary_image(decode_scale)
+
+        preview = self.image_blender.blend_preview(primary, aligned, mask, scale, progress, primary_preview)
+        return cv2.resize(preview, (primary.shape[1], primary.shape[0]))
+
+    def preview_scale(self, image):
+        scale = 1.0
+        while image.shape[0] * image.shape[1] * scale * scale > PREVIEW_MAX_PIXELS:
+            scale /= 2
+        return scale
+
+    def show_merge_preview(self, preview):
+        self.set_label_image(preview, False)
+
+    def commit_merge(self, finished_handler=None):
+        """
+        Blend the pending merge at full resolution and display it, then call finished_handler().
+        A preview still being blended is cancelled, as the full resolution blend replaces it. The
+        blend itself is not cancelled, so a save or new primary waiting on it always happens.
+        """
+        if self.queue_if_busy(lambda: self.commit_merge(finished_handler), "Committing once the current task is done..."):
+            return
+
+        if self.pending_merge is None:
+            if finished_handler is not None:
+                finished_handler()
+            return
+
+        (primary, aligned, mask) = self.pending_merge
+        self.start_task(lambda progress: self.image_blender.blend(primary, aligned, mask, progress_callback=progress),
+                        lambda new_result_image: self.show_committed_merge(new_result_image, finished_handler),
+                        "Blending at full resolution...", cancellable=False)
+
+    def show_committed_merge(self, new_result_image, finished_handler):
+        self.pending_merge = None
         self.set_label_image(new_result_image, False)
+        if finished_handler is not None:
+            finished_handler()
 
     def save_image(self):
-        cv2.imwrite("result-gui.jpg", self.visible_image)
+        self.commit_merge(lambda: cv2.imwrite("result-gui.jpg", self.visible_image))
 
     def set_primary(self):
+        self.commit_merge(self.set_visible_image_as_primary)
+
+    def set_visible_image_as_primary(self):
         self.primary = self.visible_image
         self.build_highlight_and_merged(int(self.images_combo.currentText()))
 
 
 if __name__ == "__main__":
-    gui = TouristRemovalGui()
+    parser = argparse.ArgumentParser(description="Remove tourists by blending aligned photos of a scene.")
+    add_aligner_arguments(parser)
+    # Qt handles its own options from sys.argv
+    arguments, qt_arguments = parser.parse_known_args()
+
+    gui = TouristRemovalGui(aligner_options_from_arguments(arguments))
     gui.run()
     cv2.waitKey(0)
 
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+import BatchProcessor
+from TouristRemovalApp import AppInstance, INTERMEDIATE_OUTPUT_NONE
+
+FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test1')
+
+
+def identity_align(app_instance, secondary_image_index):
+    # Feature detection is not what these tests are about, and the secondary images of test1 are
+    # close enough to the primary for blends to be meaningful without it
+    secondary_image = app_instance.image_source.get_secondary_image(secondary_image_index)
+    app_instance.store_aligned_image(secondary_image, secondary_image_index)
+
+
+class BatchProcessorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.align_nth_secondary_image = AppInstance.align_nth_secondary_image
+        AppInstance.align_nth_secondary_image = identity_align
+        self.work_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        AppInstance.align_nth_secondary_image = self.align_nth_secondary_image
+        shutil.rmtree(self.work_folder)
+
+    def interleaved_commands(self, prefix):
+        return [
+            '--cmd load "' + FOLDER + '"',
+            '--cmd align 2',
+            '--cmd align 3',
+            '--cmd blend 2 100 100 200 150',
+            '--cmd save "' + os.path.join(self.work_folder, prefix + 'a.jpg') + '"',
+            '--cmd blend 3 300 200 150 150',
+            '--cmd save "' + os.path.join(self.work_folder, prefix + 'b.jpg') + '"',
+            '--cmd align 4',
+            '--cmd blend 4 50 300 100 100',
+            '--cmd save "' + os.path.join(self.work_folder, prefix + 'c.jpg') + '"',
+        ]
+
+    def read_file(self, filename):
+        with open(os.path.join(self.work_folder, filename), 'rb') as image_file:
+            return image_file.read()
+
+    def test_split_into_stage_runs(self):
+        scene = BatchProcessor.Scene(FOLDER, self.interleaved_commands(''))
+        self.assertEqual([stage for stage, commands in scene.stage_runs],
+                         ['decode', 'align', 'blend', 'encode', 'blend', 'encode', 'align', 'blend', 'encode'])
+        self.assertEqual([len(commands) for stage, commands in scene.stage_runs], [1, 2, 1, 1, 1, 1, 1, 1, 1])
+
+    def test_interleaved_blends_and_saves_match_serial_run(self):
+        AppInstance(headless=True, intermediate_output=INTERMEDIATE_OUTPUT_NONE).run_as_commandline_app(
+            self.interleaved_commands('serial_'))
+
+        script_path = os.path.join(self.work_folder, 'script.txt')
+        with open(script_path, 'w') as script_file:
+            script_file.write('\n'.join(self.interleaved_commands('batch_')[1:]))
+
+        succeeded = BatchProcessor.BatchProcessor().run([(FOLDER, script_path)])
+        self.assertEqual(succeeded, 1)
+
+        # Every save must see the result as it was at that point of the script
+        for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+            self.assertEqual(self.read_file('batch_' + name), self.read_file('serial_' + name), name)
+        self.assertNotEqual(self.read_file('batch_a.jpg'), self.read_file('batch_b.jpg'))
+
+    def test_many_scenes(self):
+        script_path = os.path.join(self.work_folder, 'script.txt')
+        with open(script_path, 'w') as script_file:
+            script_file.write('\n'.join(self.interleaved_commands('batch_')[1:]))
+
+        # More scenes than can be in flight at once, going back and forth between stages
+        batch_processor = BatchProcessor.BatchProcessor(queue_size=1)
+        scene_count = batch_processor.max_scenes_in_flight + 3
+        self.assertEqual(batch_processor.run([(FOLDER, script_path)] * scene_count), scene_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
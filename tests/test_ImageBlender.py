@@ -0,0 +1,214 @@
+import unittest
+import numpy as np
+import scipy as sp
+import scipy.signal
+import ImageBlender
+
+# Absolute tolerance of the float64 pyramid functions against the reference, on 0..255 images.
+# The separable passes only reorder the multiply-adds of the 5x5 convolution.
+FLOAT64_TOLERANCE = 1e-9
+
+# Same for float32 images, which the pyramid functions keep in float32
+FLOAT32_TOLERANCE = 1e-3
+
+# run_blend() rounds its output to the nearest integer, the reference is compared before truncation
+RUN_BLEND_TOLERANCE = 0.5 + 1e-6
+
+# (rows, cols) of the test images: odd, even and mixed sizes, all deep enough for 2 levels
+SHAPES = [(67, 101), (128, 96), (75, 64)]
+
+
+# Reference implementation: the loop based pyramid functions the vectorized ones replaced.
+# They only take single channel (r, c) float images.
+
+def reference_reduce(image):
+    kernel = ImageBlender.generatingKernel(0.4)
+    convolvedImage = sp.signal.convolve2d(image, kernel, 'same')
+    (rowCount, colCount) = convolvedImage.shape
+    subsampledImage = convolvedImage[np.arange(0, rowCount, 2), :]
+    return subsampledImage[:, np.arange(0, colCount, 2)]
+
+
+def reference_expand(image):
+    (rowCount, colCount) = image.shape
+    upSampledImage = np.ndarray(shape=(rowCount * 2, colCount * 2), dtype=image.dtype)
+    for r in np.arange(2 * rowCount):
+        for c in np.arange(2 * colCount):
+            if r % 2 == 1 or c % 2 == 1:
+                upSampledImage[r][c] = 0
+            else:
+                upSampledImage[r, c] = image[r / 2, c / 2]
+
+    kernel = ImageBlender.generatingKernel(0.4)
+    return 4 * sp.signal.convolve2d(upSampledImage, kernel, 'same')
+
+
+def reference_gauss_pyramid(image, levels):
+    output = [image]
+    for level in np.arange(levels):
+        output.append(reference_reduce(output[level]))
+    return output
+
+
+def reference_lapl_pyramid(gaussPyr):
+    output = []
+    for i in np.arange(len(gaussPyr) - 1):
+        (gaussLayerR, gaussLayerC) = gaussPyr[i].shape
+        expandResult = reference_expand(gaussPyr[i + 1])[:gaussLayerR, :gaussLayerC]
+        output.append(gaussPyr[i] - expandResult)
+    output.append(gaussPyr[len(gaussPyr) - 1])
+    return output
+
+
+def reference_blend(laplPyrWhite, laplPyrBlack, gaussPyrMask):
+    blended_pyr = []
+    for i in np.arange(len(laplPyrWhite)):
+        whiteImg = laplPyrWhite[i]
+        blackImg = laplPyrBlack[i]
+        mask = gaussPyrMask[i]
+        (rowCount, colCount) = mask.shape
+        result = np.ndarray(shape=(rowCount, colCount), dtype=np.float)
+        for r in np.arange(rowCount):
+            for c in np.arange(colCount):
+                result[r, c] = mask[r, c] * whiteImg[r, c] + (1 - mask[r, c]) * blackImg[r, c]
+        blended_pyr.append(result)
+    return blended_pyr
+
+
+def reference_collapse(pyramid):
+    layerCount = len(pyramid)
+    onGoingSum = pyramid[layerCount - 1]
+    for layer in np.arange(layerCount - 2, -1, -1):
+        (rowCount, colCount) = pyramid[layer].shape
+        onGoingSum = reference_expand(onGoingSum)[:rowCount, :colCount] + pyramid[layer]
+    return onGoingSum
+
+
+def reference_run_blend(black_image, white_image, mask, depth):
+    """ Return the float collapse of the reference blend, before clipping and truncation. """
+    gauss_pyr_mask = reference_gauss_pyramid(mask, depth)
+    lapl_pyr_black = reference_lapl_pyramid(reference_gauss_pyramid(black_image, depth))
+    lapl_pyr_white = reference_lapl_pyramid(reference_gauss_pyramid(white_image, depth))
+    return reference_collapse(reference_blend(lapl_pyr_white, lapl_pyr_black, gauss_pyr_mask))
+
+
+def per_channel(function, image):
+    """ Apply a single channel reference function to each channel of an (r, c, channels) image. """
+    if image.ndim == 2:
+        return function(image)
+    return np.dstack([function(image[:, :, channel]) for channel in range(image.shape[2])])
+
+
+def random_image(shape, channels, seed):
+    random = np.random.RandomState(seed)
+    if channels == 1:
+        return random.uniform(0, 255, shape)
+    return random.uniform(0, 255, shape + (channels,))
+
+
+class PyramidTest(unittest.TestCase):
+    """
+    Compares the vectorized pyramid functions of every convolution backend with the loop based
+    reference, on odd and even sizes and on 1 and 3 channel images.
+    """
+
+    def setUp(self):
+        self.backend = ImageBlender.CONVOLUTION_BACKEND
+
+    def tearDown(self):
+        ImageBlender.set_convolution_backend(self.backend)
+
+    def assertAllClose(self, actual, expected, tolerance):
+        self.assertEqual(actual.shape, expected.shape)
+        self.assertLessEqual(np.abs(actual - expected).max(), tolerance)
+
+    def for_each_case(self):
+        """ Yield (backend, image) for every backend, shape and channel count. """
+        for backend in ImageBlender.CONVOLUTION_BACKENDS:
+            ImageBlender.set_convolution_backend(backend)
+            for seed, shape in enumerate(SHAPES):
+                for channels in (1, 3):
+                    yield backend, random_image(shape, channels, seed)
+
+    def test_reduce(self):
+        for backend, image in self.for_each_case():
+            self.assertAllClose(ImageBlender.reduce(image), per_channel(reference_reduce, image), FLOAT64_TOLERANCE)
+
+    def test_expand(self):
+        for backend, image in self.for_each_case():
+            self.assertAllClose(ImageBlender.expand(image), per_channel(reference_expand, image), FLOAT64_TOLERANCE)
+
+    def test_reduce_and_expand_float32(self):
+        for backend, image in self.for_each_case():
+            image32 = image.astype(np.float32)
+            reduced = ImageBlender.reduce(image32)
+            expanded = ImageBlender.expand(image32)
+
+            self.assertEqual(reduced.dtype, np.float32)
+            self.assertEqual(expanded.dtype, np.float32)
+            self.assertAllClose(reduced, per_channel(reference_reduce, image), FLOAT32_TOLERANCE)
+            self.assertAllClose(expanded, per_channel(reference_expand, image), FLOAT32_TOLERANCE)
+
+    def test_gauss_and_lapl_pyramid(self):
+        for backend, image in self.for_each_case():
+            depth = ImageBlender.pyramid_depth(image.shape)
+            gauss_pyr = ImageBlender.gaussPyramid(image, depth)
+            lapl_pyr = ImageBlender.laplPyramid(gauss_pyr)
+
+            channels = [image] if image.ndim == 2 else [image[:, :, channel] for channel in range(image.shape[2])]
+            reference_gauss_pyrs = [reference_gauss_pyramid(channel, depth) for channel in channels]
+            reference_lapl_pyrs = [reference_lapl_pyramid(pyramid) for pyramid in reference_gauss_pyrs]
+
+            self.assertEqual(len(gauss_pyr), depth + 1)
+            self.assertEqual(len(lapl_pyr), depth + 1)
+            for level in range(depth + 1):
+                expected_gauss = np.dstack([pyramid[level] for pyramid in reference_gauss_pyrs])
+                expected_lapl = np.dstack([pyramid[level] for pyramid in reference_lapl_pyrs])
+                if image.ndim == 2:
+                    expected_gauss = expected_gauss[:, :, 0]
+                    expected_lapl = expected_lapl[:, :, 0]
+                self.assertAllClose(gauss_pyr[level], expected_gauss, FLOAT64_TOLERANCE)
+                self.assertAllClose(lapl_pyr[level], expected_lapl, FLOAT64_TOLERANCE)
+
+    def test_blend_and_collapse(self):
+        for backend, image in self.for_each_case():
+            depth = ImageBlender.pyramid_depth(image.shape)
+            other = random_image(image.shape[:2], 1 if image.ndim == 2 else image.shape[2], 100)
+            mask = np.random.RandomState(200).uniform(0, 1, image.shape[:2])
+
+            lapl_pyr_white = ImageBlender.laplPyramid(ImageBlender.gaussPyramid(image, depth))
+            lapl_pyr_black = ImageBlender.laplPyramid(ImageBlender.gaussPyramid(other, depth))
+            gauss_pyr_mask = ImageBlender.gaussPyramid(mask, depth)
+            blended = ImageBlender.collapse(ImageBlender.blend(lapl_pyr_white, lapl_pyr_black, gauss_pyr_mask))
+
+            if image.ndim == 2:
+                expected = reference_run_blend(other, image, mask, depth)
+            else:
+                expected = np.dstack([reference_run_blend(other[:, :, channel], image[:, :, channel], mask, depth)
+                                      for channel in range(image.shape[2])])
+
+            self.assertAllClose(blended, expected, FLOAT64_TOLERANCE)
+
+    def test_run_blend(self):
+        for backend, image in self.for_each_case():
+            depth = ImageBlender.pyramid_depth(image.shape)
+            other = random_image(image.shape[:2], 1 if image.ndim == 2 else image.shape[2], 100)
+            mask = np.zeros(image.shape[:2])
+            mask[image.shape[0] // 4:image.shape[0] // 2, image.shape[1] // 3:] = 1
+
+            # The reference builds the mask pyramid without maskPyramid()'s border correction
+            outimg = ImageBlender.run_blend(other, image, mask, depth,
+                                            gauss_pyr_mask=reference_gauss_pyramid(mask, depth))[-1]
+
+            if image.ndim == 2:
+                expected = reference_run_blend(other, image, mask, depth)
+            else:
+                expected = np.dstack([reference_run_blend(other[:, :, channel], image[:, :, channel], mask, depth)
+                                      for channel in range(image.shape[2])])
+
+            self.assertEqual(outimg.dtype, np.uint8)
+            self.assertAllClose(outimg.astype(np.float64), np.clip(expected, 0, 255), RUN_BLEND_TOLERANCE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+import numpy as np
+from ImageSource import ImageSource
+
+SHAPE = (40, 30, 3)
+
+
+def random_image(seed):
+    return np.random.RandomState(seed).randint(0, 256, SHAPE).astype(np.uint8)
+
+
+class AlignedImagesTest(unittest.TestCase):
+
+    def test_images_past_the_budget_are_memmaps(self):
+        # Room for two images and their masks
+        image_bytes = np.prod(SHAPE) + np.prod(SHAPE[:2])
+        image_source = ImageSource(aligned_max_bytes=2 * image_bytes)
+
+        images = [random_image(index) for index in range(4)]
+        masks = [(image[:, :, 0] > 100).astype(np.uint8) * 255 for image in images]
+        for index, (image, mask) in enumerate(zip(images, masks)):
+            image_source.set_aligned_secondary_image(image, index, mask)
+
+        for index, (image, mask) in enumerate(zip(images, masks)):
+            aligned_image = image_source.aligned_secondary_images[index]
+            aligned_mask = image_source.get_aligned_secondary_mask(index)
+            self.assertEqual(isinstance(aligned_image, np.memmap), index >= 2)
+            self.assertEqual(isinstance(aligned_mask, np.memmap), index >= 2)
+            self.assertTrue(np.array_equal(aligned_image, image))
+            self.assertTrue(np.array_equal(aligned_mask, mask))
+
+        self.assertEqual(image_source.aligned_bytes, 2 * image_bytes)
+
+    def test_replacing_an_image_frees_its_budget(self):
+        image_source = ImageSource(aligned_max_bytes=np.prod(SHAPE))
+        image_source.set_aligned_secondary_image(random_image(0), 0)
+        image_source.set_aligned_secondary_image(random_image(1), 0)
+
+        self.assertFalse(isinstance(image_source.aligned_secondary_images[0], np.memmap))
+        self.assertEqual(image_source.aligned_bytes, np.prod(SHAPE))
+
+
+if __name__ == '__main__':
+    unittest.main()
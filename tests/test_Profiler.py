@@ -0,0 +1,70 @@
+import threading
+import time
+import unittest
+import Profiler
+
+# Sleeps are at least this long, timing checks allow this much slack
+SLEEP_SECONDS = 0.02
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = Profiler.Profiler()
+        self.profiler.start()
+
+    def tearDown(self):
+        self.profiler.stop()
+
+    def test_nested_stages(self):
+        with Profiler.stage('outer'):
+            time.sleep(SLEEP_SECONDS)
+            with Profiler.stage('inner'):
+                time.sleep(2 * SLEEP_SECONDS)
+        self.profiler.stop()
+
+        events = dict((event['name'], event) for event in self.profiler.events)
+        self.assertEqual(events['outer']['depth'], 0)
+        self.assertEqual(events['inner']['depth'], 1)
+        self.assertEqual(events['inner']['parent'], 'outer')
+
+        # The outer stage includes the inner one, but its self time does not
+        outer = events['outer']
+        inner = events['inner']
+        self.assertGreaterEqual(outer['wall_seconds'], inner['wall_seconds'] + SLEEP_SECONDS)
+        self.assertAlmostEqual(outer['self_wall_seconds'], outer['wall_seconds'] - inner['wall_seconds'])
+        self.assertEqual(inner['self_wall_seconds'], inner['wall_seconds'])
+
+        top_level = self.profiler.get_top_level_totals()
+        self.assertEqual(top_level['calls'], 1)
+        self.assertEqual(top_level['wall_seconds'], outer['wall_seconds'])
+
+        totals = self.profiler.get_stage_totals()
+        self.assertAlmostEqual(totals['outer']['self_wall_seconds'] + totals['inner']['self_wall_seconds'],
+                               top_level['wall_seconds'])
+
+    def test_threads_have_their_own_nesting(self):
+        def work():
+            with Profiler.stage('worker'):
+                time.sleep(SLEEP_SECONDS)
+
+        with Profiler.stage('main'):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        self.profiler.stop()
+
+        events = dict((event['name'], event) for event in self.profiler.events)
+        self.assertEqual(events['worker']['depth'], 0)
+        self.assertIsNone(events['worker']['parent'])
+        self.assertEqual(events['main']['self_wall_seconds'], events['main']['wall_seconds'])
+
+    def test_no_profiler(self):
+        self.profiler.stop()
+        with Profiler.stage('ignored'):
+            pass
+        self.assertEqual(self.profiler.events, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
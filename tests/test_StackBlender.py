@@ -0,0 +1,74 @@
+import unittest
+import numpy as np
+from StackBlender import StackBlender
+
+SHAPE = (37, 29, 3)
+
+
+def reference_median(primary_image, aligned_images, valid_masks):
+    """ Sort each pixel's valid samples and average the two middle ones, rounding half up. """
+    output = np.zeros(primary_image.shape, dtype=np.uint8)
+    for row in range(primary_image.shape[0]):
+        for col in range(primary_image.shape[1]):
+            samples = [primary_image[row, col]]
+            for image, mask in zip(aligned_images, valid_masks):
+                if mask is None or mask[row, col] != 0:
+                    samples.append(image[row, col])
+            samples = np.sort(np.array(samples, dtype=np.uint16), axis=0)
+            count = len(samples)
+            output[row, col] = (samples[(count - 1) // 2] + samples[count // 2] + 1) // 2
+    return output
+
+
+def random_frames(frame_count, seed):
+    random = np.random.RandomState(seed)
+    images = [random.randint(0, 256, SHAPE).astype(np.uint8) for frame in range(frame_count)]
+    masks = []
+    for frame in range(frame_count):
+        mask = np.full(SHAPE[:2], 255, dtype=np.uint8)
+        mask[:random.randint(0, SHAPE[0]), :random.randint(0, SHAPE[1])] = 0
+        masks.append(mask)
+    return images, masks
+
+
+class StackBlenderTest(unittest.TestCase):
+
+    def test_matches_reference(self):
+        for frame_count in (1, 2, 5, 8):
+            primary_image, = random_frames(1, 100 + frame_count)[0]
+            images, masks = random_frames(frame_count, frame_count)
+
+            # A small budget splits the stack into chunks of a few rows
+            for chunk_max_bytes in (1, 4096, 1 << 30):
+                output = StackBlender(chunk_max_bytes).median(primary_image, images, masks)
+                self.assertTrue(np.array_equal(output, reference_median(primary_image, images, masks)))
+
+    def test_black_pixels_inside_the_mask_count(self):
+        # Dark scene content is valid, only the mask decides what the warp did not cover
+        primary_image = np.zeros(SHAPE, dtype=np.uint8)
+        images = [np.zeros(SHAPE, dtype=np.uint8), np.full(SHAPE, 200, dtype=np.uint8)]
+        masks = [np.full(SHAPE[:2], 255, dtype=np.uint8), np.full(SHAPE[:2], 255, dtype=np.uint8)]
+
+        output = StackBlender().median(primary_image, images, masks)
+        self.assertTrue(np.array_equal(output, np.zeros(SHAPE, dtype=np.uint8)))
+
+    def test_masked_out_pixels_are_ignored(self):
+        primary_image = np.full(SHAPE, 10, dtype=np.uint8)
+        images = [np.full(SHAPE, 250, dtype=np.uint8), np.full(SHAPE, 250, dtype=np.uint8)]
+        masks = [np.zeros(SHAPE[:2], dtype=np.uint8), None]
+
+        # Only the primary image and the second image count: (10 + 250 + 1) // 2
+        output = StackBlender().median(primary_image, images, masks)
+        self.assertTrue(np.array_equal(output, np.full(SHAPE, 130, dtype=np.uint8)))
+
+    def test_missing_images_are_skipped(self):
+        primary_image, = random_frames(1, 7)[0]
+        images, masks = random_frames(3, 8)
+
+        output = StackBlender().median(primary_image, [images[0], None, images[2]], [masks[0], None, masks[2]])
+        expected = reference_median(primary_image, [images[0], images[2]], [masks[0], masks[2]])
+        self.assertTrue(np.array_equal(output, expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
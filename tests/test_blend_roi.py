@@ -0,0 +1,116 @@
+import unittest
+import numpy as np
+import ImageBlender
+from ImageMask import ImageMask
+
+# Deep enough for a pyramid of 4 levels, whose support radius (64 pixels) is well inside the image
+SHAPE = (300, 260)
+
+# maskPyramid() levels of an all ones mask stay within this of 1.0
+FLOAT64_TOLERANCE = 1e-12
+FLOAT32_TOLERANCE = 1e-6
+
+# (x, y, width, height) of the BLACK rectangles. Edges are included, so width and height 0 are
+# one pixel, and -1 is empty.
+RECTANGLES = {
+    'center': (110, 120, 40, 30),
+    'top left corner': (0, 0, 25, 35),
+    'top right corner': (SHAPE[1] - 30, 0, 29, 20),
+    'bottom left corner': (0, SHAPE[0] - 20, 40, 19),
+    'bottom right corner': (SHAPE[1] - 10, SHAPE[0] - 15, 9, 14),
+    'partly out of bounds': (-20, 200, 60, 150),
+    'one pixel': (130, 150, 0, 0),
+    'zero size': (130, 150, -1, -1),
+    'out of bounds': (SHAPE[1] + 10, 20, 30, 30),
+}
+
+
+def random_image(seed):
+    return np.random.RandomState(seed).randint(0, 256, SHAPE + (3,)).astype(np.uint8)
+
+
+class BlendRoiTest(unittest.TestCase):
+    """
+    blend_roi() and blend_tiled() must give exactly the blend() of the full image.
+    """
+
+    def setUp(self):
+        self.white_image = random_image(1)
+        self.black_image = random_image(2)
+
+    def assertBlendsMatch(self, mask, name):
+        image_blender = ImageBlender.ImageBlender()
+        expected = image_blender.blend(self.white_image, self.black_image, mask)
+
+        roi = image_blender.blend_roi(self.white_image, self.black_image, mask)
+        self.assertTrue(np.array_equal(roi, expected), "blend_roi() differs from blend() for " + name)
+
+        tiled = image_blender.blend_tiled(self.white_image, self.black_image, mask, tile_size=96)
+        self.assertTrue(np.array_equal(tiled, expected), "blend_tiled() differs from blend() for " + name)
+
+    def test_image_masks(self):
+        image_blender = ImageBlender.ImageBlender()
+        for name, rectangle in sorted(RECTANGLES.items()):
+            self.assertBlendsMatch(image_blender.create_rectangular_mask(SHAPE, rectangle), name)
+
+    def test_shape_masks(self):
+        for name, rectangle in sorted(RECTANGLES.items()):
+            self.assertBlendsMatch(ImageMask(SHAPE).add_rectangle(*rectangle), name)
+
+    def test_several_rectangles(self):
+        mask = ImageMask(SHAPE)
+        for name, rectangle in sorted(RECTANGLES.items()):
+            mask.add_rectangle(*rectangle)
+        self.assertBlendsMatch(mask, "all rectangles")
+
+    def test_empty_mask_is_white_image(self):
+        mask = ImageMask(SHAPE).add_rectangle(*RECTANGLES['zero size'])
+        self.assertIsNone(mask.bounding_box())
+
+        roi = ImageBlender.ImageBlender().blend_roi(self.white_image, self.black_image, mask)
+        self.assertTrue(np.array_equal(roi, self.white_image))
+
+
+class MaskPyramidTest(unittest.TestCase):
+    """
+    maskPyramid() divides out the zero padding of reduce(), so WHITE stays 1.0 up to the border.
+    """
+
+    def test_all_ones_stays_one(self):
+        for dtype, tolerance in ((np.float64, FLOAT64_TOLERANCE), (np.float32, FLOAT32_TOLERANCE)):
+            for shape in (SHAPE, (67, 101), (128, 96)):
+                depth = ImageBlender.pyramid_depth(shape)
+                pyramid = ImageBlender.maskPyramid(np.ones(shape, dtype=dtype), depth)
+
+                self.assertEqual(len(pyramid), depth + 1)
+                for level in pyramid:
+                    self.assertEqual(level.dtype, dtype)
+                    self.assertLessEqual(np.abs(level - 1).max(), tolerance)
+
+    def test_plain_pyramid_darkens_border(self):
+        # What the normalization corrects: without it the border of an all ones mask drops below 1
+        depth = ImageBlender.pyramid_depth(SHAPE)
+        pyramid = ImageBlender.gaussPyramid(np.ones(SHAPE), depth)
+        self.assertLess(pyramid[1][0, 0], 1 - 0.1)
+
+    def test_values_stay_in_range(self):
+        mask = np.random.RandomState(3).uniform(0, 1, SHAPE)
+        mask[:, :20] = 0
+        mask[-20:, :] = 1
+        for level in ImageBlender.maskPyramid(mask, ImageBlender.pyramid_depth(SHAPE)):
+            self.assertGreaterEqual(level.min(), 0)
+            self.assertLessEqual(level.max(), 1 + FLOAT64_TOLERANCE)
+
+    def test_shape_mask_pyramid(self):
+        # ImageMask computes the same normalized pyramid analytically
+        mask = ImageMask(SHAPE).add_rectangle(*RECTANGLES['top left corner']) \
+                               .add_rectangle(*RECTANGLES['center'])
+        depth = ImageBlender.pyramid_depth(SHAPE)
+        expected = ImageBlender.maskPyramid(mask.render(np.float64), depth)
+
+        for level, expected_level in zip(mask.gauss_pyramid(depth, np.float64), expected):
+            self.assertLessEqual(np.abs(level - expected_level).max(), FLOAT64_TOLERANCE)
+
+
+if __name__ == '__main__':
+    unittest.main()